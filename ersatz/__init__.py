@@ -9,6 +9,13 @@ class DummyArgs():
     def __init__(self):
         return
 
+def _split_module():
+    import importlib
+    module = importlib.import_module('.split', __name__)
+    # importing the submodule binds it to `ersatz.split`, which would shadow the api function
+    globals()['split'] = _split_api
+    return module
+
 def split(model="default-multilingual",
           text=None,
           input=None,
@@ -17,8 +24,15 @@ def split(model="default-multilingual",
           candidates="multilingual",
           cpu=False,
           columns=None,
-          delimiter='\t'):
-    from .split import split as ersatz_split
+          delimiter='\t',
+          pack=False,
+          workers=1,
+          quantize=None,
+          threshold=0.5,
+          emit_scores=None,
+          stream=None,
+          result_cache=None):
+    ersatz_split = _split_module().split
     args = DummyArgs()
     args.model = model
     args.text = text
@@ -29,9 +43,35 @@ def split(model="default-multilingual",
     args.cpu = cpu
     args.columns = columns
     args.delimiter = delimiter
+    args.pack = pack
+    args.workers = workers
+    args.quantize = quantize
+    args.threshold = threshold
+    args.emit_scores = emit_scores
+    args.stream = stream
+    args.result_cache = result_cache
     args.list = True
+    args.cache = True
     return ersatz_split(args)
 
+_split_api = split
+
+
+def unload(model="default-multilingual",
+           cpu=False,
+           candidates="multilingual",
+           quantize=None):
+    module = _split_module()
+    return module.MODEL_CACHE.unload(model, module.get_device(cpu or quantize is not None), candidates, quantize)
+
+
+def clear_cache():
+    _split_module().MODEL_CACHE.clear()
+
+
+def set_cache_size(size):
+    _split_module().MODEL_CACHE.max_size = size
+
 
 def train():
     raise NotImplementedError
@@ -0,0 +1,191 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .utils import ERSATZ_DIR
+
+logger = logging.getLogger('ersatz')
+
+RESULT_CACHE_PATH = os.path.join(ERSATZ_DIR, 'cache', 'results.sqlite')
+
+# digest of a model file, so that results are never shared between two different models
+def file_checksum(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def apply_cuts(content, cuts):
+    bounds = [0] + cuts + [len(content)]
+    return '\n'.join(content[start:end].strip() for start, end in zip(bounds[:-1], bounds[1:])).strip()
+
+# the character offsets in the raw line where the segmented output starts a new sentence,
+# so the output is apply_cuts(content, cuts). None if the output cannot be rebuilt from the
+# line this way (sentencepiece normalized the text); the output itself is stored instead
+def line_cuts(content, output):
+    cuts = []
+    position = 0
+    for number, segment in enumerate(output.split('\n')):
+        start = content.find(segment, position)
+        if start < 0:
+            return None
+        if number > 0:
+            cuts.append(start)
+        position = start + len(segment)
+    if apply_cuts(content, cuts) != output:
+        return None
+    return cuts
+
+# segmentation results of whole lines, in a sqlite file with an in-memory LRU in front of it
+# entries are keyed by a digest of (model checksum, candidate set, threshold, line hash) and hold
+# the cut offsets of the line. New entries and hits are written in batches; once the file holds
+# more than max_bytes, the least recently used entries are deleted
+class ResultCache():
+    def __init__(self, path=RESULT_CACHE_PATH, max_bytes=1 << 30, memory_size=100000, flush_size=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_size = memory_size
+        self.flush_size = flush_size
+        self.memory = OrderedDict()
+        self.writes = {}
+        self.touched = set()
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                    '(key BLOB PRIMARY KEY, cuts TEXT, output TEXT, used REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def key(self, model, candidates, threshold, content):
+        line = hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+        return hashlib.blake2b(f'{model}\t{candidates}\t{threshold!r}\t'.encode('utf-8') + line,
+                               digest_size=16).digest()
+
+    def get(self, key, content):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                value = self.memory[key]
+            else:
+                row = self.connection.execute('SELECT cuts, output FROM results WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                cuts, output = row
+                value = ([int(cut) for cut in cuts.split()], None) if cuts is not None else (None, output)
+                self.remember(key, value)
+            self.touched.add(key)
+            if len(self.writes) + len(self.touched) >= self.flush_size:
+                self.write()
+        cuts, output = value
+        if cuts is None:
+            return output
+        return apply_cuts(content, cuts)
+
+    def put(self, key, content, output):
+        cuts = line_cuts(content, output)
+        value = (cuts, None) if cuts is not None else (None, output)
+        with self.lock:
+            self.remember(key, value)
+            self.writes[key] = value
+            if len(self.writes) + len(self.touched) >= self.flush_size:
+                self.write()
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        if len(self.writes) == 0 and len(self.touched) == 0:
+            return
+        now = time.time()
+        rows = [(key, ' '.join(map(str, cuts)) if cuts is not None else None, output, now)
+                for key, (cuts, output) in self.writes.items()]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO results (key, cuts, output, used) VALUES (?, ?, ?, ?)',
+                                        rows)
+            self.connection.executemany('UPDATE results SET used = ? WHERE key = ?',
+                                        [(now, key) for key in self.touched if key not in self.writes])
+        self.writes = {}
+        self.touched = set()
+        self.evict()
+
+    # the size is measured in used database pages; deleted entries free pages that later writes reuse
+    def size(self):
+        page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+        pages = self.connection.execute('PRAGMA page_count').fetchone()[0]
+        free = self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+        return (pages - free) * page_size
+
+    def evict(self):
+        size = self.size()
+        if size <= self.max_bytes:
+            return
+        # down to 90% of the limit so eviction does not run on every write
+        count = self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        evicted = max(1, int(count * (size - self.max_bytes * 0.9) / size))
+        with self.connection:
+            self.connection.execute('DELETE FROM results WHERE key IN '
+                                    '(SELECT key FROM results ORDER BY used LIMIT ?)', (evicted,))
+        logger.debug(f'Evicted {evicted} entries from {self.path}')
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+# the lookups of one run through a shared ResultCache, with its own hit and miss counts
+class CacheLookups():
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model, candidates, threshold, content):
+        return self.cache.key(model, candidates, threshold, content)
+
+    def get(self, key, content):
+        output = self.cache.get(key, content)
+        if output is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return output
+
+    def put(self, key, content, output):
+        self.cache.put(key, content, output)
+
+    def flush(self):
+        self.cache.flush()
+
+# one cache per file and process, shared by every model that uses it
+RESULT_CACHES = {}
+RESULT_CACHES_LOCK = threading.Lock()
+
+def open_result_cache(path=RESULT_CACHE_PATH, max_bytes=1 << 30, memory_size=100000):
+    with RESULT_CACHES_LOCK:
+        cache = RESULT_CACHES.get(path, None)
+        if cache is None:
+            cache = ResultCache(path, max_bytes=max_bytes, memory_size=memory_size)
+            RESULT_CACHES[path] = cache
+        cache.max_bytes = max_bytes
+        cache.memory_size = memory_size
+        return cache
@@ -1,4 +1,5 @@
 import re
+from bisect import bisect_left
 
 # sentence ending punctuation
 # U+0964  ।   Po  DEVANAGARI DANDA
@@ -88,30 +89,92 @@ list_set = {
     '\u4e00' 
 }
 
+digits = {"0", "1", "2", "3", "4", "5", "6", "7", "8", "9"}
+
+# finds every character offset that directly follows a run of [ending][ending|closing]*
+# along with the position of the last ending character before it. Only single
+# characters of each set take part, same as the per-character `in` checks below
+class PunctuationRuns():
+    def __init__(self, ending, closing):
+        self.ending = {ch for ch in ending if len(ch) == 1}
+        trailing = self.ending | {ch for ch in closing if len(ch) == 1}
+        ending_class = ''.join(re.escape(ch) for ch in sorted(self.ending))
+        trailing_class = ''.join(re.escape(ch) for ch in sorted(trailing))
+        self.regex = re.compile(f'[{ending_class}][{trailing_class}]*')
+
+    def __call__(self, text):
+        for match in self.regex.finditer(text):
+            anchor = match.start()
+            for offset in range(match.start() + 1, match.end() + 1):
+                if text[offset-1] in self.ending:
+                    anchor = offset - 1
+                yield offset, anchor
+
+
 class Split():
     def __call__(self, left_context, right_context):
         return True
 
+    # returns the (0-based) positions of the pieces that are followed by a candidate site
+    # text is the joined pieces with '\u2581' as ' ' and offsets[i] where piece i starts
+    # pad is what the contexts are filled with past either end of text
+    def scan(self, text, offsets, left_context_size, right_context_size, pad='<pad>'):
+        size = len(offsets) - 1
+        if type(self).__call__ is Split.__call__:
+            return list(range(size))
+        positions = []
+        for index in range(size):
+            left_start = index - left_context_size + 1
+            right_end = index + right_context_size + 1
+            left = pad * max(-left_start, 0) + text[offsets[max(left_start, 0)]:offsets[index+1]]
+            right = text[offsets[index+1]:offsets[min(right_end, size)]] + pad * max(right_end - size, 0)
+            if self(left, right):
+                positions.append(index)
+        return positions
+
+    # maps the character sites of a PunctuationRuns scan onto piece positions
+    # a site counts when it falls on a piece boundary, its ending character is still
+    # inside the left context, and the first character of the right context passes `follows`
+    def scan_runs(self, runs, text, offsets, left_context_size, pad, follows):
+        positions = []
+        for offset, anchor in runs(text):
+            index = bisect_left(offsets, offset)
+            if index == 0 or index == len(offsets) or offsets[index] != offset:
+                continue
+            index -= 1
+            if anchor < offsets[max(index - left_context_size + 1, 0)]:
+                continue
+            next_ch = text[offset] if offset < len(text) else pad[:1]
+            if next_ch != '' and follows(next_ch):
+                positions.append(index)
+        return positions
+
 
 class PunctuationSpace(Split):
+    regex = re.compile('.*[?!.][.?!")\']*')
+    runs = PunctuationRuns('?!.', '.?!")\'')
+
     def __call__(self, left_context, right_context):
         if right_context[0] == ' ':
-            regex = '.*[?!.][.?!")\']*'
-            regex = re.compile(regex)
-            if regex.fullmatch(left_context) is not None:
+            if self.regex.fullmatch(left_context) is not None:
                 return True
         return False
 
+    def scan(self, text, offsets, left_context_size, right_context_size, pad='<pad>'):
+        return self.scan_runs(self.runs, text, offsets, left_context_size, pad, lambda ch: ch == ' ')
+
 class Lists(Split):
     def __call__(self, left_context, right_context):
         if right_context.strip()[0] in ['*', '-', '~']:
             return True
 
 class MultilingualPunctuation(Split):
+    runs = PunctuationRuns(ending_punc, closing_punc)
+
     def __call__(self, left_context, right_context):
         try:
             left_context = left_context.split(' ')[-1]
-            if right_context[0] not in ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]:
+            if right_context[0] not in digits:
                 for i, ch in enumerate(left_context):
                     if ch in ending_punc:
                         for j, next_ch in enumerate(left_context[i:], i):
@@ -124,12 +187,17 @@ class MultilingualPunctuation(Split):
             return False
         return False
 
+    def scan(self, text, offsets, left_context_size, right_context_size, pad='<pad>'):
+        return self.scan_runs(self.runs, text, offsets, left_context_size, pad, lambda ch: ch not in digits)
+
 
 class AdditionalMultilingualPunctuation(Split):
+    runs = PunctuationRuns(additional_ending_punc, closing_punc)
+
     def __call__(self, left_context, right_context):
         try:
             left_context = left_context.split(' ')[-1]
-            if right_context[0] not in ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]:
+            if right_context[0] not in digits:
                 for i, ch in enumerate(left_context):
                     if ch in additional_ending_punc:
                         for j, next_ch in enumerate(left_context[i:], i):
@@ -142,10 +210,14 @@ class AdditionalMultilingualPunctuation(Split):
             return False
         return False
 
+    def scan(self, text, offsets, left_context_size, right_context_size, pad='<pad>'):
+        return self.scan_runs(self.runs, text, offsets, left_context_size, pad, lambda ch: ch not in digits)
+
 
 class IndividualPunctuation(Split):
     def __init__(self, unicode_char):
         self.punc = unicode_char
+        self.runs = PunctuationRuns({unicode_char}, closing_punc)
 
     def __call__(self, left_context, right_context):
         if right_context[0] == ' ':
@@ -158,3 +230,6 @@ class IndividualPunctuation(Split):
                     if j != -1:
                         return True
         return False
+
+    def scan(self, text, offsets, left_context_size, right_context_size, pad='<pad>'):
+        return self.scan_runs(self.runs, text, offsets, left_context_size, pad, lambda ch: ch == ' ')
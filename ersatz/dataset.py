@@ -5,14 +5,23 @@ import pathlib
 import sys
 import logging
 import argparse
+import json
+import shutil
+import multiprocessing
+import itertools
+import numpy as np
+import torch
+from functools import lru_cache
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
 
 if __package__ is None and __name__ == '__main__':
     parent = pathlib.Path(__file__).absolute().parents[1]
     sys.path.insert(0, str(parent))
     __package__ = 'ersatz'
 
-from .subword import Vocabulary, SentencePiece
+from .subword import Vocabulary, SentencePiece, piece_offsets
 from .candidates import MultilingualPunctuation, PunctuationSpace, Split
+from .utils import shard_offsets, open_shard
 
 logger = logging.getLogger('ersatz')
 
@@ -20,9 +29,14 @@ logger = logging.getLogger('ersatz')
 
 # iterates over a file and yields one doc at a time with the appropriately
 # labelled splits; documents are separated by empty lines
-def document_generator(file_path, tokenizer=None):
+# start/end restrict it to a byte range of the file (see shard_offsets)
+def document_generator(file_path, tokenizer=None, start=0, end=None):
     document = []
-    with open(file_path) as input_file:
+    if end is None:
+        input_file = open(file_path)
+    else:
+        input_file = open_shard(file_path, start, end)
+    with input_file:
         for line in input_file:
             if len(tokenizer.encode(line, out_type=str)) > 0:
                 line = line.strip()
@@ -38,80 +52,315 @@ def document_generator(file_path, tokenizer=None):
                 document = []
     yield document
 
+# yields every (left context, right context, label) training example of the
+# given plain text files (or (path, start, end) byte ranges of them);
+# only the sites accepted by the determiner are kept
+def training_examples(file_paths,
+                      tokenizer,
+                      left_context_size=5,
+                      right_context_size=5,
+                      determiner=None):
+    for file_path in file_paths:
+        start, end = 0, None
+        if isinstance(file_path, tuple):
+            file_path, start, end = file_path
+        for doc in document_generator(file_path, tokenizer=tokenizer, start=start, end=end):
+            if len(doc) > 0:
+                # doc alternates pieces and labels; contexts are checked with the pads removed
+                pieces = doc[0::2]
+                candidates = set(determiner.scan(''.join(pieces).replace('\u2581', ' '), piece_offsets(pieces),
+                                                 left_context_size, right_context_size, pad=''))
+                left_temp = ["<pad>" for x in range(left_context_size-1)] + [doc[0]]
+                right_temp = [x for x in doc[1:(2*right_context_size)+1] if x not in ["<eos>", "<mos>"]]
+                temp_index = 2*right_context_size+2
+                for index, word in enumerate(doc):
+                    if word in ['<eos>', '<mos>']:
+
+                        label = word
+
+                        if index // 2 in candidates:
+                            yield list(left_temp), list(right_temp), label
+
+                        left_temp.pop(0)
+                        left_temp.append(right_temp.pop(0))
+                        if temp_index < len(doc):
+                            right_temp.append(doc[temp_index])
+                            temp_index += 2
+                        else:
+                            right_temp.append("<pad>")
+
 # this builds all the training data from a plain text file
-# writes it out to a new file
+# writes it out to a new file, either as text or as a binary dataset
+# returns the number of examples written
 def split_train_file(file_paths,
                      tokenizer,
                      output_path=None,
                      left_context_size=5,
                      right_context_size=5,
-                     determiner=None):
-
-    random.seed(14)
-
-    # import pdb; pdb.set_trace()
+                     determiner=None,
+                     binary=False,
+                     shuffle=False,
+                     shuffle_buckets=32,
+                     seed=14):
+
+    random.seed(seed)
+
+    examples = training_examples(file_paths, tokenizer,
+                                 left_context_size=left_context_size,
+                                 right_context_size=right_context_size,
+                                 determiner=determiner)
+    if shuffle:
+        examples = shuffle_examples(examples, f'{output_path}.shuffle', buckets=shuffle_buckets, rng=random.Random(seed))
+    if binary:
+        return write_binary_dataset(examples, output_path, tokenizer, left_context_size, right_context_size)
+
+    size = 0
     with open(output_path, 'w') as f:
-        for file_path in file_paths:
-            for doc in document_generator(file_path, tokenizer=tokenizer):
-                if len(doc) > 0:
-                    left_temp = ["<pad>" for x in range(left_context_size-1)] + [doc[0]]
-                    right_temp = [x for x in doc[1:(2*right_context_size)+1] if x not in ["<eos>", "<mos>"]]
-                    temp_index = 2*right_context_size+2
-                    for index, word in enumerate(doc):
-                        if word in ['<eos>', '<mos>']:
-
-                            label = word
-
-                            if determiner(''.join(left_temp).replace('\u2581', ' ').replace('<pad>', ''),
-                                          ''.join(right_temp).replace('\u2581', ' ').replace('<pad>', '')):
-                                f.write(' '.join(left_temp) + ' ||| ' + ' '.join(right_temp) + ' ||| ' + label + '\n')
-
-                            left_temp.pop(0)
-                            left_temp.append(right_temp.pop(0))
-                            if temp_index < len(doc):
-                                right_temp.append(doc[temp_index])
-                                temp_index += 2
-                            else:
-                                right_temp.append("<pad>")
-# split test files
-# the difference between this and the previous is there are no labels in data
-def split_test_file(document, tokenizer, left_context_size, right_context_size):
-    document = tokenizer.encode(document, out_type=str)
-    left_contexts = []
-    right_contexts = []
-    if len(document) > 0:
-        left_temp = ["<pad>" for x in range(left_context_size - 1)] + [document[0]]
-        right_temp = [x for x in document[1:(right_context_size) + 1]]
-        while (len(right_temp) < right_context_size):
-            right_temp.append("<pad>")
-        temp_index = right_context_size + 1
-        for index, word in enumerate(document, 0):
-            left_contexts.append(' '.join(left_temp))
-
-            right_contexts.append(' '.join(right_temp))
-
-            left_temp.pop(0)
-            left_temp.append(right_temp.pop(0))
-            if temp_index < len(document):
-                right_temp.append(document[temp_index])
-                temp_index += 1
-            else:
-                right_temp.append("<pad>")
-    return left_contexts, right_contexts
-
-
+        for left_temp, right_temp, label in examples:
+            f.write(' '.join(left_temp) + ' ||| ' + ' '.join(right_temp) + ' ||| ' + label + '\n')
+            size += 1
+    return size
+
+def load_determiner(determiner_type):
+    if determiner_type == "en":
+        return PunctuationSpace()
+    elif determiner_type == "multilingual":
+        return MultilingualPunctuation()
+    else:
+        return Split()
+
+# one preprocessing process: writes the examples of its byte ranges to its own shard
+def preprocess_shard(job):
+    ranges, sentencepiece_path, output_path, left_context_size, right_context_size, \
+        determiner_type, binary, shuffle, shuffle_buckets, seed = job
+    tokenizer = SentencePiece(model_path=sentencepiece_path)
+    size = split_train_file(ranges, tokenizer,
+                            output_path=output_path,
+                            left_context_size=left_context_size,
+                            right_context_size=right_context_size,
+                            determiner=load_determiner(determiner_type),
+                            binary=binary,
+                            shuffle=shuffle,
+                            shuffle_buckets=shuffle_buckets,
+                            seed=seed)
+    return output_path, size
+
+# the same as split_train_file over `jobs` processes. The input files are cut into blocks of
+# whole documents which are dealt out to the processes; each process writes its own shard
+# (output_path.0, output_path.1, ...) and output_path becomes a manifest listing the shards
+def split_train_file_parallel(file_paths,
+                              sentencepiece_path,
+                              output_path=None,
+                              left_context_size=5,
+                              right_context_size=5,
+                              determiner_type='multilingual',
+                              binary=False,
+                              shuffle=False,
+                              shuffle_buckets=32,
+                              seed=14,
+                              jobs=2):
+    # several blocks per process keeps the shards similar in size when files are not
+    total = sum(os.path.getsize(file_path) for file_path in file_paths)
+    block_size = max(total // (jobs * 4), 1)
+    blocks = []
+    for file_path in file_paths:
+        offsets = shard_offsets(file_path, max(os.path.getsize(file_path) // block_size, 1), documents=True)
+        blocks += [(file_path, start, end) for start, end in zip(offsets[:-1], offsets[1:])]
+
+    work = [(blocks[k::jobs], sentencepiece_path, f'{output_path}.{k}', left_context_size, right_context_size,
+             determiner_type, binary, shuffle, shuffle_buckets, seed + k) for k in range(jobs)]
+    work = [job for job in work if len(job[0]) > 0]
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(len(work)) as pool:
+        shards = pool.map(preprocess_shard, work)
+
+    manifest = {
+        'ersatz_manifest': 1,
+        'format': 'binary' if binary else 'text',
+        'left_context_size': left_context_size,
+        'right_context_size': right_context_size,
+        'size': sum(size for _, size in shards),
+        # paths are relative to the manifest
+        'shards': [{'path': os.path.basename(shard_path), 'size': size} for shard_path, size in shards],
+    }
+    with open(output_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write('\n')
+    logger.info(f"Wrote {manifest['size']} examples to {len(shards)} shards listed in {output_path}")
+    return manifest['size']
+
+# full shuffle with bounded memory: examples are scattered over random on-disk
+# buckets, and each bucket is then shuffled in memory (about 1/buckets of the data)
+def shuffle_examples(examples, temp_prefix, buckets=32, rng=random):
+    bucket_paths = [f'{temp_prefix}.{b}.tmp' for b in range(buckets)]
+    bucket_files = [open(path, 'w') for path in bucket_paths]
+    try:
+        for example in examples:
+            bucket_files[rng.randrange(buckets)].write(json.dumps(example) + '\n')
+    finally:
+        for bucket_file in bucket_files:
+            bucket_file.close()
+    for path in bucket_paths:
+        with open(path) as bucket_file:
+            bucket = bucket_file.readlines()
+        os.remove(path)
+        rng.shuffle(bucket)
+        for line in bucket:
+            yield json.loads(line)
+
+# streaming shuffle: holds `buffer_size` items and emits a random one for every new item
+def shuffle_buffer(items, buffer_size, rng):
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+        else:
+            index = rng.randrange(buffer_size)
+            yield buffer[index]
+            buffer[index] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+# the same shuffle over the example indices of a binary dataset, one batch at a time:
+# blocks of indices are streamed in a random order and every incoming block takes the
+# place of a random batch drawn from the buffer
+def shuffle_buffer_indices(size, buffer_size, batch_size, rng):
+    blocks = rng.permutation((size + batch_size - 1) // batch_size)
+    buffer = np.empty(0, dtype=np.int64)
+    for block in blocks:
+        block = np.arange(block * batch_size, min((block + 1) * batch_size, size))
+        if len(buffer) < buffer_size or len(block) < batch_size:
+            buffer = np.concatenate((buffer, block))
+            continue
+        slots = rng.choice(len(buffer), batch_size, replace=False)
+        batch = buffer[slots]
+        buffer[slots] = block
+        yield np.sort(batch)
+    buffer = rng.permutation(buffer)
+    for start in range(0, len(buffer), batch_size):
+        yield np.sort(buffer[start:start+batch_size])
 
-def write_training_files(file_path, left_contexts, right_contexts, labels, left_context_size=5, right_context_size=5):
-    output_path = file_path.split('/')[-1].split('.')
-    output_path = output_path[:-1] + [f'{left_context_size}-{right_context_size}-context'] + output_path[-1:]
-    output_path = os.path.join('/'.join(file_path.split('/')[:-1]),'.'.join(output_path))
+#######################################################################################################
+# binary datasets
+#
+# layout: BINARY_MAGIC, a little-endian uint32 header length, a json header, and then
+# three arrays (each aligned to BINARY_ALIGNMENT bytes from the start of the file):
+#   contexts: (size, left + right) token ids, int16 or int32
+#   factors:  (size, left + right) source factor codes, uint8
+#   labels:   (size,) 0 for <eos>, 1 for <mos>, uint8
+
+BINARY_MAGIC = b'ERSATZ-BIN\x01'
+BINARY_ALIGNMENT = 64
+
+# manifests of sharded datasets (split_train_file_parallel) are small json objects with an
+# 'ersatz_manifest' key; only files that could be one are parsed
+MANIFEST_MAX_SIZE = 1 << 24
+
+def read_manifest(data_path):
+    if os.path.getsize(data_path) > MANIFEST_MAX_SIZE:
+        return None
+    with open(data_path, 'rb') as f:
+        content = f.read()
+    if not content.lstrip().startswith(b'{'):
+        return None
+    try:
+        manifest = json.loads(content.decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or 'ersatz_manifest' not in manifest:
+        return None
+    return manifest
+
+# number of lines of a text file, counted in the calling process so len() of a text dataset is
+# known before any DataLoader worker reads it
+def count_lines(data_path, chunk_size=1 << 20):
+    lines = 0
+    last = b'\n'
+    with open(data_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return lines + (last != b'\n')
+
+def is_binary_dataset(data_path):
+    with open(data_path, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+def read_binary_header(data_path):
+    with open(data_path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise Exception(f"{data_path} is not a binary ersatz dataset")
+        length = int.from_bytes(f.read(4), 'little')
+        return json.loads(f.read(length).decode('utf-8'))
+
+def write_binary_dataset(examples, output_path, tokenizer, left_context_size, right_context_size, chunk_size=65536):
+    id_dtype = np.int16 if len(tokenizer) <= np.iinfo(np.int16).max else np.int32
+    source_factors = SourceFactors()
+    temp_paths = [f'{output_path}.{name}.tmp' for name in ('contexts', 'factors', 'labels')]
+    size = 0
+    with open(temp_paths[0], 'wb') as contexts_file, \
+         open(temp_paths[1], 'wb') as factors_file, \
+         open(temp_paths[2], 'wb') as labels_file:
+        contexts, factors, labels = [], [], []
+        for left, right, label in examples:
+            # same check as the text reader; short documents do not fill the right context
+            if len(left) != left_context_size or len(right) != right_context_size:
+                continue
+            contexts.append([tokenizer.embed_word(t) for t in left + right])
+            factors.append(source_factors.compute(left) + source_factors.compute(right))
+            labels.append(0 if label == '<eos>' else 1)
+            if len(labels) >= chunk_size:
+                np.asarray(contexts, dtype=id_dtype).tofile(contexts_file)
+                np.asarray(factors, dtype=np.uint8).tofile(factors_file)
+                np.asarray(labels, dtype=np.uint8).tofile(labels_file)
+                size += len(labels)
+                contexts, factors, labels = [], [], []
+        if len(labels) > 0:
+            np.asarray(contexts, dtype=id_dtype).tofile(contexts_file)
+            np.asarray(factors, dtype=np.uint8).tofile(factors_file)
+            np.asarray(labels, dtype=np.uint8).tofile(labels_file)
+            size += len(labels)
+
+    header = {
+        'size': size,
+        'left_context_size': left_context_size,
+        'right_context_size': right_context_size,
+        'id_dtype': np.dtype(id_dtype).name,
+        'vocab_size': len(tokenizer),
+        'tokenizer': tokenizer.checksum(),
+    }
+    # array offsets depend on the header length, which depends on the offsets
+    position = len(BINARY_MAGIC) + 4 + len(json.dumps(header)) + 256
+    for name, temp_path in zip(('contexts', 'factors', 'labels'), temp_paths):
+        position += -position % BINARY_ALIGNMENT
+        header[name] = position
+        position += os.path.getsize(temp_path)
+    encoded = json.dumps(header).encode('utf-8')
+
+    with open(output_path, 'wb') as f:
+        f.write(BINARY_MAGIC)
+        f.write(len(encoded).to_bytes(4, 'little'))
+        f.write(encoded)
+        for name, temp_path in zip(('contexts', 'factors', 'labels'), temp_paths):
+            f.write(b'\x00' * (header[name] - f.tell()))
+            with open(temp_path, 'rb') as temp_file:
+                shutil.copyfileobj(temp_file, f)
+            os.remove(temp_path)
+    logger.info(f'Wrote {size} examples to {output_path}')
+    return size
+
+# windows over an already encoded document: pads the id sequence once and returns a
+# strided (len(ids), left + right) view where row i holds ids[i-left+1:i+right+1]
+def context_tensor(ids, left_context_size, right_context_size, pad_id):
+    ids = torch.as_tensor(ids, dtype=torch.long)
+    padded = torch.cat((ids.new_full((left_context_size - 1,), pad_id),
+                        ids,
+                        ids.new_full((right_context_size,), pad_id)))
+    return padded.unfold(0, left_context_size + right_context_size, 1)
 
-    with open(output_path, 'w') as f:
-        for left, right, label in zip(left_contexts, right_contexts, labels):
-            f.write(' '.join(left) + ' ||| ' + ' '.join(right) + ' ||| ' + label + '\n')
 
 class SourceFactors():
-    def __init__(self):
+    def __init__(self, cache_size=65536):
         self.codes = {
             'UNMARK': 0,
             'CAP': 1,
@@ -120,60 +369,99 @@ class SourceFactors():
             'TITLE': 4,
             'NUMBER': 5
         }
-        pass
+        # frequent words are looked up instead of recomputed
+        self.code = lru_cache(maxsize=cache_size)(self.compute_code)
+
+    # factor of a whole (detokenized) word
+    def compute_code(self, untok):
+        if untok.istitle():
+            return self.codes['TITLE']
+        elif untok.isupper():
+            return self.codes['CAP']
+        elif untok.islower():
+            return self.codes['LOWER']
+        elif untok in string.punctuation:
+            return self.codes['PUNC']
+        else:
+            for w in untok:
+                if w in string.digits:
+                    return self.codes['NUMBER']
+            return self.codes['UNMARK']
 
     # specific to sentencepiece
     def compute(self, token_stream):
         word = []
         output_stream = []
-        token_stream = token_stream.split()
+        if isinstance(token_stream, str):
+            token_stream = token_stream.split()
         for t in token_stream + ['\u2581']:
             if '\u2581' in t:
-                out = None
                 # potentially add a marker for truncated words in left context
                 if len(word) > 0:
-                    untok = ''.join(word).replace('\u2581', '')
-                    if untok.istitle():
-                        out = [self.codes['TITLE'] for w in word]
-                    elif untok.isupper():
-                        out = [self.codes['CAP'] for w in word]
-                    elif untok.islower():
-                        out = [self.codes['LOWER'] for w in word]
-                    elif untok in string.punctuation:
-                        out = [self.codes['PUNC'] for w in word]
-                    else:
-                        for w in untok:
-                            if w in string.digits:
-                                out = [self.codes['NUMBER'] for w in word]
-                                break
-                        if not out:
-                            out = [self.codes['UNMARK'] for w in word]
-                    output_stream += out
+                    output_stream += [self.code(''.join(word).replace('\u2581', ''))] * len(word)
                 word = []
             word.append(t)
         assert(len(output_stream)==len(token_stream))
         return output_stream
 
-
-class ErsatzDataset():
+    # same as calling compute() on the left and right context of every position, but the
+    # words are coded once for the whole document. Only the words cut by a window edge
+    # (truncated words, or words merged with <pad>) are recomputed for each window
+    def compute_windows(self, pieces, positions, left_context_size, right_context_size):
+        padded = ['<pad>'] * (left_context_size - 1) + list(pieces) + ['<pad>'] * right_context_size
+        size = len(padded)
+        bounds = [0] + [i for i, t in enumerate(padded) if i > 0 and '\u2581' in t] + [size]
+        doc_codes = [0] * size
+        word_start = [0] * size
+        word_end = [0] * size
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            doc_codes[start:end] = [self.code(''.join(padded[start:end]).replace('\u2581', ''))] * (end - start)
+            word_start[start:end] = [start] * (end - start)
+            word_end[start:end] = [end] * (end - start)
+
+        def window(start, end):
+            codes = doc_codes[start:end]
+            first = min(word_end[start], end)
+            codes[:first-start] = [self.code(''.join(padded[start:first]).replace('\u2581', ''))] * (first - start)
+            if first < end:
+                last = word_start[end-1]
+                codes[last-start:] = [self.code(''.join(padded[last:end]).replace('\u2581', ''))] * (end - last)
+            return codes
+
+        context_size = left_context_size + right_context_size
+        return [window(p, p + left_context_size) + window(p + left_context_size, p + context_size) for p in positions]
+
+
+class ErsatzDataset(IterableDataset):
     def __init__(self, data_path, device,
                  left_context_size=15,
                  right_context_size=5,
                  sentencepiece_path=None,
-                 tokenizer=None):
+                 tokenizer=None,
+                 shuffle_buffer=0,
+                 seed=14,
+                 rank=0,
+                 world_size=1):
+        if not os.path.exists(data_path):
+            raise Exception("path does not exist")
+
+        self.manifest = read_manifest(data_path)
+        if self.manifest is not None:
+            shard_paths = [os.path.join(os.path.dirname(data_path), shard['path']) for shard in self.manifest['shards']]
+        else:
+            shard_paths = [data_path]
+
         if tokenizer is None:
             if sentencepiece_path is not None:
                 self.tokenizer = SentencePiece(model_path=sentencepiece_path)
             else:
                 self.tokenizer = Vocabulary()
-                self.tokenizer.build_vocab(data_path)
+                for shard_path in shard_paths:
+                    self.tokenizer.build_vocab(shard_path)
         else:
             self.tokenizer = tokenizer
         self.device = device
         self.size = 0
-    
-        if not os.path.exists(data_path):
-            raise Exception("path does not exist")
 
         self.left_context_size = left_context_size
         self.right_context_size = right_context_size
@@ -181,21 +469,198 @@ class ErsatzDataset():
         self.data_path = data_path
         self.source_factors = SourceFactors()
 
+        # examples are shuffled through a buffer of this size; 0 reads them in file order
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        # distributed training: every rank reads its own part of the data
+        self.rank = rank
+        self.world_size = world_size
+        # set by loader()
+        self.batch_size = None
+        self.skip = None
+        self.first_reader = 0
+        # batches passed over by the last batchify(skip=...)
+        self.skipped = 0
+        # determiner masks by determiner name
+        self.masks = {}
+
+        self.shards = []
+        if self.manifest is not None:
+            self.binary = self.manifest['format'] == 'binary'
+            self.shards = [ErsatzDataset(shard_path, device,
+                                         left_context_size=left_context_size,
+                                         right_context_size=right_context_size,
+                                         tokenizer=self.tokenizer,
+                                         shuffle_buffer=shuffle_buffer,
+                                         seed=seed + k,
+                                         rank=rank,
+                                         world_size=world_size)
+                           for k, shard_path in enumerate(shard_paths)]
+            self.size = self.manifest['size']
+            return
+
+        self.binary = is_binary_dataset(data_path)
+        if self.binary:
+            self.load_binary()
+        else:
+            self.size = count_lines(data_path)
+
+    # memory-maps a dataset written by write_binary_dataset
+    def load_binary(self):
+        header = read_binary_header(self.data_path)
+        if header['left_context_size'] != self.left_context_size or header['right_context_size'] != self.right_context_size:
+            raise Exception(f"{self.data_path} was built with {header['left_context_size']}/{header['right_context_size']} context, "
+                            f"expected {self.left_context_size}/{self.right_context_size}")
+        if header['tokenizer'] != self.tokenizer.checksum():
+            raise Exception(f"{self.data_path} was built with a different tokenizer")
+        self.size = header['size']
+        if self.size == 0:
+            raise Exception(f"{self.data_path} is empty")
+        context_size = self.left_context_size + self.right_context_size
+        self.contexts = np.memmap(self.data_path, dtype=header['id_dtype'], mode='r',
+                                  offset=header['contexts'], shape=(self.size, context_size))
+        self.factors = np.memmap(self.data_path, dtype=np.uint8, mode='r',
+                                 offset=header['factors'], shape=(self.size, context_size))
+        self.labels = np.memmap(self.data_path, dtype=np.uint8, mode='r',
+                                offset=header['labels'], shape=(self.size,))
+
     def __len__(self):
         return self.size
 
-    def batchify(self, batch_size):
+    # each epoch gets its own shuffle order
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        for shard in self.shards:
+            shard.set_epoch(epoch)
+
+    def epoch_seed(self):
+        return self.seed * 1000003 + self.epoch
+
+    # the number of examples batchify() yields over the whole data
+    def example_count(self):
+        if len(self.shards) > 0:
+            return sum(shard.example_count() for shard in self.shards)
+        if self.binary:
+            return self.size
+        count = 0
+        with open(self.data_path) as f:
+            for line in f:
+                fields = line.strip().split('|||')
+                if len(fields) == 3 and len(fields[0].split()) == self.left_context_size \
+                        and len(fields[1].split()) == self.right_context_size:
+                    count += 1
+        return count
+
+    # whether the determiner accepts each example (in batchify order) as a candidate site.
+    # computed once and cached next to the data (data_path.<determiner>.<tokenizer>.<left>-<right>.mask);
+    # a cached mask is recomputed when the data is newer or its length does not match the examples
+    def determiner_mask(self, determiner):
+        if self.shuffle_buffer > 0:
+            raise Exception("determiner masks need the examples in file order")
+        # IndividualPunctuation is one class for many characters
+        name = type(determiner).__name__ + ''.join(f'-{ord(ch):x}' for ch in getattr(determiner, 'punc', ''))
+        if name in self.masks:
+            return self.masks[name]
+        cache_path = f'{self.data_path}.{name}.{self.tokenizer.checksum()[:12]}.' \
+                     f'{self.left_context_size}-{self.right_context_size}.mask'
+        data_paths = [self.data_path] + [shard.data_path for shard in self.shards]
+        mask = None
+        if os.path.exists(cache_path) and \
+                os.path.getmtime(cache_path) >= max(os.path.getmtime(data_path) for data_path in data_paths):
+            mask = np.fromfile(cache_path, dtype=np.bool_)
+            if len(mask) != self.example_count():
+                logger.warning(f'{cache_path} does not match the data; recomputing it')
+                mask = None
+        if mask is None:
+            mask = []
+            for _, _, _, context_strings in self.batchify(4096):
+                for left, right in context_strings:
+                    mask.append(bool(determiner(self.tokenizer.merge(left), self.tokenizer.merge(right))))
+            mask = np.asarray(mask, dtype=np.bool_)
+            try:
+                mask.tofile(cache_path)
+            except OSError:
+                logger.warning(f'Could not cache the determiner mask at {cache_path}')
+        self.masks[name] = torch.from_numpy(mask)
+        return self.masks[name]
+
+    # (index, count) of this reader among all the ranks and their DataLoader workers
+    def worker_split(self):
+        worker, num_workers = 0, 1
+        info = get_worker_info()
+        if info is not None:
+            worker, num_workers = self.reader(info), info.num_workers
+        return self.rank * num_workers + worker, self.world_size * num_workers
+
+    # the part of the data DataLoader worker `info` reads
+    def reader(self, info):
+        return (info.id + self.first_reader) % info.num_workers
+
+    # iterated by a DataLoader (see loader()), each worker reads its own part of the data;
+    # batches come with the id of the reader (part of the data) they belong to
+    def __iter__(self):
+        info = get_worker_info()
+        worker = 0 if info is None else self.reader(info)
+        skip = 0 if self.skip is None else self.skip[worker]
+        for context, factors, label, _ in self.batchify(self.batch_size, skip=skip):
+            yield context, factors, label, worker
+
+    # background batches: num_workers processes build the batches while the model trains;
+    # workers are restarted every epoch so they see the current set_epoch().
+    # resuming in the middle of an epoch, skip[r] batches of reader r are passed over and
+    # the DataLoader's round robin over the workers starts at reader first_reader
+    def loader(self, batch_size, num_workers=0, pin_memory=False, prefetch_factor=2, skip=None, first_reader=0):
+        if skip is not None and len(skip) != max(num_workers, 1):
+            raise Exception(f"cannot resume the data position of {len(skip)} workers with {num_workers} workers")
+        self.batch_size = batch_size
+        self.skip = skip
+        self.first_reader = first_reader
+        for shard in self.shards:
+            shard.first_reader = first_reader
+        # its own generator, so creating the workers does not advance the global (dropout) rng
+        generator = torch.Generator().manual_seed(self.epoch_seed())
+        if num_workers > 0:
+            return DataLoader(self, batch_size=None, num_workers=num_workers, pin_memory=pin_memory,
+                              prefetch_factor=prefetch_factor, generator=generator)
+        return DataLoader(self, batch_size=None, pin_memory=pin_memory, generator=generator)
+
+    # when read by several ranks or DataLoader workers, each one gets a different part
+    # of every file (a byte range of a text file, every n-th batch of a binary one).
+    # the first `skip` batches are passed over without building them
+    def batchify(self, batch_size, skip=0):
+        self.skipped = 0
+        if len(self.shards) > 0:
+            yield from self.sharded_batchify(batch_size, skip)
+            return
+        if self.binary:
+            yield from self.binary_batchify(batch_size, skip)
+            return
         data = []
         context_strings = []
         batch_idx = 0
         #factors = []
-        with open(self.data_path) as f:
-            for line in f:
-                self.size += 1
+        worker, num_workers = self.worker_split()
+        if num_workers > 1:
+            offsets = shard_offsets(self.data_path, num_workers)
+            if worker + 1 >= len(offsets):
+                return
+            input_file = open_shard(self.data_path, offsets[worker], offsets[worker+1])
+        else:
+            input_file = open(self.data_path)
+        with input_file as f:
+            lines = f
+            if self.shuffle_buffer > 0:
+                lines = shuffle_buffer(f, self.shuffle_buffer, random.Random((self.epoch_seed() << 16) + worker))
+            skipped_examples = 0
+            for line in lines:
                 if len(line.strip().split('|||')) == 3:
                     left, right, label = line.strip().split('|||')
                     # little check because some datasets have '|||' ... maybe change eventually to special character code ?
                     if (len(left.split()) == self.left_context_size) and (len(right.split()) == self.right_context_size):
+                        if skipped_examples < skip * batch_size:
+                            skipped_examples += 1
+                            continue
                         data.append((left.strip(), self.source_factors.compute(left.strip()),
                                      right.strip(), self.source_factors.compute(right.strip()),
                                      label.strip()))
@@ -209,13 +674,64 @@ class ErsatzDataset():
                     batch_idx += 1
                     data = []
                     context_strings = []
-            context, factors, label = self.tokenizer.context_to_tensor(data)
-            context = context.view(len(data), -1)
-            factors = factors.view(len(data), -1)
-            label = label.view(len(data))
             if len(data) > 0:
+                context, factors, label = self.tokenizer.context_to_tensor(data)
+                context = context.view(len(data), -1)
+                factors = factors.view(len(data), -1)
+                label = label.view(len(data))
                 yield context, factors, label, context_strings
                 batch_idx += 1
+            self.skipped = (skipped_examples + batch_size - 1) // batch_size
+
+    # shards are read one after the other (in a random order every epoch when shuffling);
+    # the last batch of each shard may be smaller than batch_size
+    def sharded_batchify(self, batch_size, skip=0):
+        shards = list(self.shards)
+        if self.shuffle_buffer > 0:
+            random.Random(self.epoch_seed()).shuffle(shards)
+        for shard in shards:
+            yield from shard.batchify(batch_size, skip=skip - self.skipped)
+            self.skipped += shard.skipped
+
+    def binary_batchify(self, batch_size, skip=0):
+        if self.shuffle_buffer > 0:
+            rows = shuffle_buffer_indices(self.size, self.shuffle_buffer, batch_size,
+                                          np.random.default_rng(self.epoch_seed()))
+        else:
+            rows = (slice(start, min(start + batch_size, self.size)) for start in range(0, self.size, batch_size))
+        worker, num_workers = self.worker_split()
+        # every worker draws the same (seeded) sequence of batches and keeps its share
+        rows = itertools.islice(rows, worker, None, num_workers)
+        for row in rows:
+            # skipped batches are never read
+            if self.skipped < skip:
+                self.skipped += 1
+                continue
+            context = torch.from_numpy(self.contexts[row].astype(np.int64))
+            factors = torch.from_numpy(self.factors[row].astype(np.int64))
+            label = torch.from_numpy(self.labels[row].astype(np.int64))
+            yield context, factors, label, BinaryContextStrings(self, row, len(label))
+
+
+# the (left, right) context strings of a batch (slice or index array) of a binary dataset,
+# only decoded when iterated over (validation) so training batches stay free of per-example work
+class BinaryContextStrings():
+    def __init__(self, dataset, rows, size):
+        self.dataset = dataset
+        self.rows = rows
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        tokenizer = self.dataset.tokenizer
+        left_size = self.dataset.left_context_size
+        # '<pad>' usually shares the <unk> id, so ids lose the surface of unknown pieces
+        pad_id = tokenizer.embed_word('<pad>')
+        for row in self.dataset.contexts[self.rows].tolist():
+            pieces = ['<pad>' if i == pad_id else tokenizer.get_word(i) for i in row]
+            yield ' '.join(pieces[:left_size]), ' '.join(pieces[left_size:])
 
 ##############################################################################
 
@@ -241,6 +757,19 @@ def parse_args():
                             "   * all: all possible contexts")
     parser.add_argument('--input_paths', nargs='*', default=None,
                         help="Paths to raw text input files")
+    parser.add_argument('--binary', action='store_true',
+                        help="Writes a pre-tensorized binary dataset (token ids, factors and labels) instead of text.\n"
+                             "   The trainer memory-maps it instead of re-parsing the text every epoch")
+    parser.add_argument('--shuffle', action='store_true',
+                        help="Shuffles the examples before writing them (replaces a separate `shuf` pass)")
+    parser.add_argument('--shuffle-buckets', type=int, default=32,
+                        help="Number of on-disk buckets used by --shuffle; each bucket is shuffled in memory")
+    parser.add_argument('--seed', type=int, default=14,
+                        help="Random seed for --shuffle")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="Number of processes. With more than one, the input is split into blocks of whole\n"
+                             "   documents, every process writes its own shard (OUTPUT_PATH.0, OUTPUT_PATH.1, ...)\n"
+                             "   and OUTPUT_PATH becomes a manifest of the shards that the trainer reads")
     args = parser.parse_args()
     return args
 
@@ -253,18 +782,28 @@ def main():
         logger.error("ERROR: No --sentencepiece_path was given. Training one as part of preprocessing is not currently supported.")
         sys.exit(-1)
 
-    if args.determiner_type == "en":
-        determiner = PunctuationSpace()
-    elif args.determiner_type == "multilingual":
-        determiner = MultilingualPunctuation()
-    else:
-        determiner = Split()
+    if args.jobs > 1:
+        split_train_file_parallel(args.input_paths, args.sentencepiece_path,
+                                  output_path=args.output_path,
+                                  left_context_size=args.left_size,
+                                  right_context_size=args.right_size,
+                                  determiner_type=args.determiner_type,
+                                  binary=args.binary,
+                                  shuffle=args.shuffle,
+                                  shuffle_buckets=args.shuffle_buckets,
+                                  seed=args.seed,
+                                  jobs=args.jobs)
+        return
 
     split_train_file(args.input_paths, tokenizer,
                      output_path=args.output_path,
                      left_context_size=args.left_size,
                      right_context_size=args.right_size,
-                     determiner=determiner)
+                     determiner=load_determiner(args.determiner_type),
+                     binary=args.binary,
+                     shuffle=args.shuffle,
+                     shuffle_buckets=args.shuffle_buckets,
+                     seed=args.seed)
 
 
 if __name__ == '__main__':
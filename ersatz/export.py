@@ -0,0 +1,252 @@
+import os
+import io
+import sys
+import json
+import base64
+import pathlib
+import zipfile
+import logging
+import argparse
+import torch
+import torch.nn as nn
+
+if __package__ is None and __name__ == '__main__':
+    parent = pathlib.Path(__file__).absolute().parents[1]
+    sys.path.insert(0, str(parent))
+    __package__ = 'ersatz'
+
+from . import __version__
+from .subword import SentencePiece
+
+logger = logging.getLogger('ersatz')
+
+METADATA_NAME = 'ersatz.json'
+TOKENIZER_NAME = 'tokenizer.model'
+
+#######################################################################################################
+
+# everything EvalModel needs besides the network itself; the sentencepiece proto travels
+# next to it (a TorchScript extra file, base64 in the ONNX metadata)
+def export_metadata(model, export_format):
+    return {
+        'format': export_format,
+        'version': __version__,
+        'left_context_size': model.left_context_size,
+        'right_context_size': model.right_context_size,
+        'source_factors': model.source_factors,
+        'quantized': getattr(model, 'quantized', None),
+        'tokenizer_checksum': model.tokenizer.checksum()
+    }
+
+# random contexts used to trace the model and to compare the export against it
+def example_inputs(model, batch_size=8):
+    context_size = model.left_context_size + model.right_context_size
+    generator = torch.Generator().manual_seed(14)
+    src = torch.randint(len(model.tokenizer), (batch_size, context_size), generator=generator)
+    if not model.source_factors:
+        return (src,)
+    factors = torch.randint(6, (batch_size, context_size), generator=generator)
+    return (src, factors)
+
+# the exported graphs take the factors as a second positional input instead of a keyword
+class ExportWrapper(nn.Module):
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, src, factors=None):
+        return self.model(src, factors=factors)
+
+def export_torchscript(model, output_path):
+    inputs = example_inputs(model)
+    with torch.no_grad():
+        module = torch.jit.trace(ExportWrapper(model).eval(), inputs)
+    metadata = export_metadata(model, 'torchscript')
+    extra_files = {
+        METADATA_NAME: json.dumps(metadata),
+        TOKENIZER_NAME: model.tokenizer.model.serialized_model_proto()
+    }
+    torch.jit.save(module, output_path, _extra_files=extra_files)
+    return metadata
+
+def export_onnx(model, output_path, opset=17):
+    if getattr(model, 'quantized', None) is not None:
+        raise Exception('Quantized models can only be exported to TorchScript')
+    try:
+        import onnx
+    except ImportError:
+        raise Exception('Exporting to ONNX requires the onnx package (pip install ersatz[onnx])')
+
+    inputs = example_inputs(model)
+    input_names = ['contexts', 'factors'][:len(inputs)]
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + ['scores']}
+    buffer = io.BytesIO()
+    with torch.no_grad():
+        torch.onnx.export(ExportWrapper(model).eval(), inputs, buffer, input_names=input_names,
+                          output_names=['scores'], dynamic_axes=dynamic_axes, opset_version=opset,
+                          dynamo=False)
+
+    onnx_model = onnx.load_from_string(buffer.getvalue())
+    metadata = export_metadata(model, 'onnx')
+    properties = {
+        METADATA_NAME: json.dumps(metadata),
+        TOKENIZER_NAME: base64.b64encode(model.tokenizer.model.serialized_model_proto()).decode('ascii')
+    }
+    for key, value in properties.items():
+        entry = onnx_model.metadata_props.add()
+        entry.key = key
+        entry.value = value
+    onnx.save(onnx_model, output_path)
+    return metadata
+
+#######################################################################################################
+
+# onnx files are recognized by their extension, TorchScript archives by the metadata they carry;
+# anything else is a regular checkpoint
+def exported_format(model_path):
+    if str(model_path).endswith('.onnx'):
+        return 'onnx'
+    if os.path.isfile(model_path) and zipfile.is_zipfile(model_path):
+        with zipfile.ZipFile(model_path) as archive:
+            if any(name.endswith(f'extra/{METADATA_NAME}') for name in archive.namelist()):
+                return 'torchscript'
+    return None
+
+# stands in for ErsatzTransformer at inference: same attributes and forward signature
+class ExportedModel(nn.Module):
+    def __init__(self, metadata, tokenizer):
+        super(ExportedModel, self).__init__()
+        self.tokenizer = tokenizer
+        self.left_context_size = metadata['left_context_size']
+        self.right_context_size = metadata['right_context_size']
+        self.source_factors = metadata['source_factors']
+        self.quantized = metadata.get('quantized', None)
+        self.metadata = metadata
+
+    # same decisions as ErsatzTransformer.predict, from the exported log-probabilities
+    def predict(self, src, factors=None, margin=False):
+        scores = self.forward(src, factors=factors)
+        scores = scores[:, 0] - scores[:, 1]
+        if margin:
+            return scores
+        return scores >= 0
+
+class ScriptedModel(ExportedModel):
+    def __init__(self, model_path):
+        extra_files = {METADATA_NAME: '', TOKENIZER_NAME: ''}
+        module = torch.jit.load(model_path, map_location=torch.device('cpu'), _extra_files=extra_files)
+        super(ScriptedModel, self).__init__(json.loads(extra_files[METADATA_NAME]),
+                                            SentencePiece(serialization=extra_files[TOKENIZER_NAME]))
+        self.module = module
+
+    def forward(self, src, factors=None):
+        if factors is None:
+            return self.module(src)
+        return self.module(src, factors)
+
+class OnnxModel(ExportedModel):
+    def __init__(self, model_path):
+        try:
+            import onnx
+            import onnxruntime
+        except ImportError:
+            raise Exception('Loading ONNX models requires the onnx and onnxruntime packages (pip install ersatz[onnx])')
+        properties = {entry.key: entry.value for entry in onnx.load(model_path, load_external_data=False).metadata_props}
+        if METADATA_NAME not in properties:
+            raise Exception(f'{model_path} was not exported by ersatz')
+        super(OnnxModel, self).__init__(json.loads(properties[METADATA_NAME]),
+                                        SentencePiece(serialization=base64.b64decode(properties[TOKENIZER_NAME])))
+        self.model_path = model_path
+        self.onnxruntime = onnxruntime
+        self.session = None
+        self.device = torch.device('cpu')
+
+    def to(self, device):
+        device = torch.device(device)
+        if device != self.device or self.session is None:
+            providers = ['CPUExecutionProvider']
+            if device.type == 'cuda':
+                if 'CUDAExecutionProvider' not in self.onnxruntime.get_available_providers():
+                    raise Exception('onnxruntime was installed without CUDA support')
+                providers.insert(0, ('CUDAExecutionProvider', {'device_id': device.index or 0}))
+            self.session = self.onnxruntime.InferenceSession(self.model_path, providers=providers)
+            self.device = device
+        return self
+
+    def forward(self, src, factors=None):
+        if self.session is None:
+            self.to(self.device)
+        inputs = {'contexts': src.cpu().numpy()}
+        if factors is not None:
+            inputs['factors'] = factors.cpu().numpy()
+        output = self.session.run(['scores'], inputs)[0]
+        return torch.from_numpy(output).to(src.device)
+
+def load_exported(model_path):
+    export_format = exported_format(model_path)
+    if export_format == 'torchscript':
+        model = ScriptedModel(model_path)
+    elif export_format == 'onnx':
+        model = OnnxModel(model_path)
+    else:
+        raise Exception(f'{model_path} is not an exported ersatz model')
+    model.eval()
+    return model
+
+#######################################################################################################
+
+# runs the same contexts through the eager model and the exported one
+def compare_export(model, exported, batch_size=37):
+    inputs = example_inputs(model, batch_size=batch_size)
+    with torch.no_grad():
+        expected = model(*inputs)
+        found = exported(*inputs)
+    agreement = (expected.argmax(1) == found.argmax(1)).float().mean().item()
+    return (expected - found).abs().max().item(), agreement
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Exports an ersatz model to TorchScript and/or ONNX.\n"
+        "      Example: ersatz_export --model en --torchscript en.ts.pt --onnx en.onnx",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--model', '-m', default='default-multilingual',
+                        help="Either name of or path to a pre-trained ersatz model")
+    parser.add_argument('--torchscript', default=None, metavar='PATH',
+                        help="Writes a TorchScript module with the tokenizer and context sizes embedded")
+    parser.add_argument('--onnx', default=None, metavar='PATH',
+                        help="Writes an ONNX file with the tokenizer and context sizes embedded\n"
+                             "  * PATH must end in .onnx; needs the onnx package")
+    parser.add_argument('--quantize', '-Q', default=None, choices=['int8'],
+                        help="Quantizes the model before exporting (TorchScript only)")
+    parser.add_argument('--opset', type=int, default=17,
+                        help="ONNX opset version")
+    args = parser.parse_args()
+    if args.torchscript is None and args.onnx is None:
+        parser.error("at least one of '--torchscript' and '--onnx' is required")
+    if args.onnx is not None and not args.onnx.endswith('.onnx'):
+        parser.error("'--onnx' paths must end in .onnx")
+    return args
+
+def main():
+    args = parse_args()
+
+    from .split import load_model, resolve_model_path
+    model = load_model(resolve_model_path(args.model), quantize=args.quantize)
+    model.requires_grad_(False)
+
+    exports = []
+    if args.torchscript is not None:
+        export_torchscript(model, args.torchscript)
+        exports.append(args.torchscript)
+    if args.onnx is not None:
+        export_onnx(model, args.onnx, opset=args.opset)
+        exports.append(args.onnx)
+
+    for path in exports:
+        difference, agreement = compare_export(model, load_exported(path))
+        logger.info(f'Wrote {path}: max score difference {difference:.2e}, '
+                    f'{agreement*100:.2f}% matching predictions')
+
+if __name__ == '__main__':
+    main()
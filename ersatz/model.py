@@ -1,3 +1,4 @@
+import copy
 import math
 import torch
 import torch.nn as nn
@@ -42,6 +43,8 @@ class ErsatzTransformer(nn.Module):
         self.args = args
         self.generator = Generator(args.embed_size+self.factor_embed_size, self.max_size,
                                    nlayers=args.linear_nlayers, activation_type=args.activation_type)
+        # see inference_state; rebuilt lazily and never part of the state_dict
+        self.inference = None
 
     def forward(self, src, factors=None):
         if self.transformer:
@@ -62,6 +65,61 @@ class ErsatzTransformer(nn.Module):
         #output = self.embed_dropout(embed)
         return self.generator(embed)
 
+    # inference-only weights derived from the model: the embeddings with the sqrt(embed_size)
+    # scaling folded in, and batch-first views of the encoder layers that share their parameters.
+    # They are rebuilt when any of the weights or modules they come from change
+    def inference_state(self):
+        weights = [self.src_emb.weight]
+        if self.source_factors:
+            weights.append(self.fact_emb.weight)
+        modules = list(self.encoder.modules()) if self.transformer else []
+        key = tuple((id(x), x._version, str(x.device), x.dtype) for x in weights) + tuple(id(m) for m in modules)
+        if self.inference is None or self.inference[0] != key:
+            scale = math.sqrt(self.embed_size+self.factor_embed_size) if self.transformer else 1.0
+            embeddings = [weight.detach() * scale for weight in weights]
+            layers = [batch_first_layer(layer) for layer in self.encoder.layers] if self.transformer else []
+            # the sources are kept alive so that their ids in the key stay unique
+            self.inference = (key, embeddings, layers, weights + modules)
+        return self.inference[1], self.inference[2]
+
+    # inference-only forward: batch-first throughout (so encoder layers can take the fused
+    # fast path), no dropout, and no softmax. Returns the <eos> decisions, or with margin=True
+    # the difference between the <eos> and <mos> scores (positive means <eos>)
+    def predict(self, src, factors=None, margin=False):
+        embeddings, layers = self.inference_state()
+        embed = F.embedding(src, embeddings[0])
+        if factors is not None:
+            embed = torch.cat((embed, F.embedding(factors, embeddings[1])), dim=2)
+        if self.transformer:
+            embed = embed + self.pos_embed.pe[:src.size(1)].transpose(0, 1)
+            for layer in layers:
+                embed = layer(embed)
+            if self.encoder.norm is not None:
+                embed = self.encoder.norm(embed)
+        scores = self.generator.logits(embed)
+        scores = scores[:, 0] - scores[:, 1]
+        if margin:
+            return scores
+        return scores >= 0
+
+# a copy of a (sequence-first) encoder layer that reads batch-first input; all parameters and
+# submodules except the attention wrapper are shared with the original
+def batch_first_layer(layer):
+    # older torch ignores the flag and would attend over the batch axis
+    if not hasattr(layer.self_attn, 'batch_first'):
+        raise Exception(f'Inference needs torch 2.3 or newer (found {torch.__version__})')
+    fused = copy.copy(layer)
+    fused._modules = copy.copy(layer._modules)
+    fused.self_attn = copy.copy(layer.self_attn)
+    fused.self_attn.batch_first = True
+    fused.training = False
+    fused.self_attn.training = False
+    # the fused kernel needs float weights; quantized feed-forward layers keep the regular path,
+    # which this flag disables before the weights are inspected
+    if not isinstance(layer.linear1.weight, torch.Tensor):
+        fused.activation_relu_or_gelu = False
+    return fused
+
 class Generator(nn.Module):
     
     # could change this to mean-pool or max pool
@@ -89,13 +147,16 @@ class Generator(nn.Module):
             self.hidden_layers = None
             self.proj = nn.Linear(hidden, 2)
 
-    def forward(self, x):
+    # unnormalized scores; argmax(logits) == argmax(forward)
+    def logits(self, x):
         x = x.reshape(x.size()[0], -1)
         if self.hidden_layers is not None:
             for layer in self.hidden_layers:
                 x = layer(x)
-        x = self.proj(x)
-        return F.log_softmax(x, dim=-1)
+        return self.proj(x)
+
+    def forward(self, x):
+        return F.log_softmax(self.logits(x), dim=-1)
 
 class PositionalEncoding(nn.Module):
     
@@ -107,7 +168,7 @@ class PositionalEncoding(nn.Module):
         div_term = torch.exp(torch.arange(0, embed_size, 2).float() * (-math.log(10000.0) / embed_size))
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0,1)
+        pe = pe.unsqueeze(0).transpose(0,1).contiguous()
         self.register_buffer('pe', pe)
         
     def forward(self, x):
@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import pathlib
+import logging
+import argparse
+import http.client
+import concurrent.futures
+import torch
+
+if __package__ is None and __name__ == '__main__':
+    parent = pathlib.Path(__file__).absolute().parents[1]
+    sys.path.insert(0, str(parent))
+    __package__ = 'ersatz'
+
+from . import _split_module
+
+# imported through the package so that `ersatz.split` stays the api function
+_split = _split_module()
+EvalModel = _split.EvalModel
+QUANTIZE_TYPES = _split.QUANTIZE_TYPES
+get_device = _split.get_device
+resolve_model_path = _split.resolve_model_path
+load_candidates = _split.load_candidates
+threshold_margin = _split.threshold_margin
+
+logger = logging.getLogger('ersatz')
+
+#######################################################################################################
+
+# one request: the lines of its text with their encodings and candidate rows, and the future
+# its caller waits on
+class Job():
+    def __init__(self, lines, encodings, rows, future):
+        self.lines = lines
+        self.encodings = encodings
+        self.rows = rows
+        self.size = sum(r[0].size(0) for r in rows if r is not None)
+        self.future = future
+        self.queued = time.monotonic()
+
+# keeps one loaded EvalModel and segments the texts of concurrent callers together: queued jobs
+# are flushed into shared forward passes once batch_size candidate rows are waiting, or max_wait
+# seconds after the first of them arrived. The model only ever runs on one worker thread
+class Segmenter():
+    def __init__(self, model, batch_size=64, max_wait=0.005, candidates='multilingual', threshold=0.5):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.candidates = load_candidates(candidates)
+        self.threshold = threshold
+        self.queue = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.metrics = {
+            'requests': 0,
+            'lines': 0,
+            'rows': 0,
+            'flushes': 0,
+            'full_flushes': 0,
+            'timeout_flushes': 0,
+            'forward_passes': 0,
+            'queue_seconds': 0.0
+        }
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stats(self):
+        metrics = dict(self.metrics)
+        metrics['queue_depth'] = self.queue.qsize() if self.queue is not None else 0
+        metrics['batch_size'] = self.batch_size
+        passes = metrics['forward_passes']
+        metrics['batch_fill'] = metrics['rows'] / (passes * self.batch_size) if passes > 0 else 0.0
+        metrics['mean_rows_per_flush'] = metrics['rows'] / metrics['flushes'] if metrics['flushes'] > 0 else 0.0
+        metrics['mean_queue_ms'] = 1000 * metrics['queue_seconds'] / metrics['requests'] if metrics['requests'] > 0 else 0.0
+        return metrics
+
+    # tokenization and candidate scanning happen off the event loop, before the job is queued
+    def prepare(self, text):
+        lines = text.split('\n')
+        encodings = [self.model.encode(line) for line in lines]
+        rows = [self.model.contexts(encoding, self.candidates) for encoding in encodings]
+        return lines, encodings, rows
+
+    # segments text the same way as ersatz.split(text=...)
+    async def segment(self, text):
+        loop = asyncio.get_running_loop()
+        lines, encodings, rows = await loop.run_in_executor(None, self.prepare, text)
+        job = Job(lines, encodings, rows, loop.create_future())
+        await self.queue.put(job)
+        return await job.future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            size = jobs[0].size
+            deadline = loop.time() + self.max_wait
+            while size < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                jobs.append(job)
+                size += job.size
+            self.metrics['flushes'] += 1
+            self.metrics['full_flushes' if size >= self.batch_size else 'timeout_flushes'] += 1
+            now = time.monotonic()
+            for job in jobs:
+                self.metrics['queue_seconds'] += now - job.queued
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.flush, jobs)
+            except Exception as e:
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+            for job, result in zip(jobs, results):
+                if not job.future.done():
+                    job.future.set_result(result)
+
+    # one packed forward pass per batch_size rows over the candidate rows of every queued line,
+    # then each line is rebuilt from its own predictions
+    def flush(self, jobs):
+        lines = [(job_number, line, encoding, rows) for job_number, job in enumerate(jobs)
+                 for line, encoding, rows in zip(job.lines, job.encodings, job.rows)]
+        eos = [[] for _ in lines]
+        packed = [(rows[0], rows[1], rows[2], torch.full_like(rows[2], line_number))
+                  for line_number, (_, _, _, rows) in enumerate(lines) if rows is not None]
+        if len(packed) > 0:
+            data, factors, indices, line_numbers = [torch.cat(column) for column in zip(*packed)]
+            with torch.no_grad():
+                for start in range(0, data.size(0), self.batch_size):
+                    end = start + self.batch_size
+                    pred = self.model.predict(data[start:end], factors[start:end], threshold=self.threshold)
+                    for line_number, index in zip(line_numbers[start:end][pred].tolist(), indices[start:end][pred].tolist()):
+                        eos[line_number].append(index)
+                    self.metrics['forward_passes'] += 1
+            self.metrics['rows'] += data.size(0)
+
+        outputs = [[] for _ in jobs]
+        for (job_number, line, encoding, _), line_eos in zip(lines, eos):
+            outputs[job_number].append(self.model.reconstruct(line, encoding, line_eos).strip())
+        self.metrics['requests'] += len(jobs)
+        self.metrics['lines'] += len(lines)
+        return ['\n'.join(output).strip().split('\n') for output in outputs]
+
+#######################################################################################################
+
+# a minimal HTTP/1.1 front end:
+#   POST /split    {"text": "..."} -> {"sentences": [...]}
+#                  {"texts": ["...", ...]} -> {"sentences": [[...], ...]}
+#   GET  /metrics  queue depth, batch fill and flush counters
+#   GET  /health
+class Server():
+    def __init__(self, segmenter, max_body_size=1 << 24):
+        self.segmenter = segmenter
+        self.max_body_size = max_body_size
+
+    async def respond(self, writer, status, payload, keep_alive=True):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        reason = http.client.responses.get(status, '')
+        head = (f'HTTP/1.1 {status} {reason}\r\n'
+                f'Content-Type: application/json; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+        writer.write(head.encode('ascii') + body)
+        await writer.drain()
+
+    async def route(self, method, path, body):
+        if path == '/split':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            try:
+                request = json.loads(body.decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                return 400, {'error': f'invalid JSON: {e}'}
+            if isinstance(request, dict) and isinstance(request.get('text'), str):
+                return 200, {'sentences': await self.segmenter.segment(request['text'])}
+            if isinstance(request, dict) and isinstance(request.get('texts'), list) \
+                    and all(isinstance(text, str) for text in request['texts']):
+                sentences = await asyncio.gather(*[self.segmenter.segment(text) for text in request['texts']])
+                return 200, {'sentences': list(sentences)}
+            return 400, {'error': 'expected {"text": str} or {"texts": [str, ...]}'}
+        if path == '/metrics':
+            return 200, self.segmenter.stats()
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'unknown path {path}'}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, {'error': 'malformed request line'}, keep_alive=False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, 400, {'error': 'invalid Content-Length'}, keep_alive=False)
+                    break
+                # the body is never read, so the connection cannot be reused
+                if length > self.max_body_size:
+                    await self.respond(writer, 413, {'error': f'request body is larger than {self.max_body_size} bytes'},
+                                       keep_alive=False)
+                    break
+                body = await reader.readexactly(length)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                try:
+                    status, payload = await self.route(method, path.split('?')[0], body)
+                except Exception as e:
+                    logger.exception('request failed')
+                    status, payload = 500, {'error': str(e)}
+                await self.respond(writer, status, payload, keep_alive=keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError: idle keep-alive connections at shutdown
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_socket=None):
+        self.segmenter.start()
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+            logger.info(f'Serving on {unix_socket}')
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            logger.info(f'Serving on http://{host}:{server.sockets[0].getsockname()[1]}')
+        # SIGTERM stops the server the same way as ^C, so the unix socket is removed
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        except NotImplementedError:
+            pass
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+#######################################################################################################
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+# stdlib client for a running server, over TCP or a unix socket
+class Client():
+    def __init__(self, host='127.0.0.1', port=8000, unix_socket=None, timeout=60):
+        if unix_socket is not None:
+            self.connection = UnixHTTPConnection(unix_socket, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, payload=None):
+        body = None if payload is None else json.dumps(payload).encode('utf-8')
+        headers = {} if body is None else {'Content-Type': 'application/json'}
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+        if response.status != 200:
+            raise Exception(f'{response.status}: {result.get("error")}')
+        return result
+
+    def split(self, text):
+        return self.request('POST', '/split', {'text': text})['sentences']
+
+    def metrics(self):
+        return self.request('GET', '/metrics')
+
+    def close(self):
+        self.connection.close()
+
+#######################################################################################################
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serves an ersatz model over HTTP, batching the texts of concurrent requests together.\n"
+        "      Example: ersatz_serve --model en --port 8000\n"
+        "               curl -d '{\"text\": \"Hello. World.\"}' localhost:8000/split",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--model', '-m', default='default-multilingual',
+                        help="Either name of or path to a pre-trained ersatz model")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to listen on")
+    parser.add_argument('--port', '-p', type=int, default=8000,
+                        help="TCP port to listen on")
+    parser.add_argument('--socket', default=None, metavar='PATH',
+                        help="Listens on a unix socket instead of TCP")
+    parser.add_argument('--batch-size', '-b', type=int, default=64,
+                        help="Candidate sites that trigger a flush, and the size of each forward pass")
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help="Longest a request waits for others to share its batch")
+    parser.add_argument('--candidates', '-c', default='multilingual', choices=['multilingual', 'en', 'all'],
+                        help="Criteria for selecting candidate sites (see ersatz --help)")
+    parser.add_argument('--threshold', '-t', type=float, default=0.5,
+                        help="Minimum <eos> probability to split at")
+    parser.add_argument('--max-body-size', type=int, default=1 << 24, metavar='BYTES',
+                        help="Largest request body accepted; larger requests get a 413 response")
+    parser.add_argument('--cpu', action='store_true', help="Uses CPU (GPU is default if available)")
+    parser.add_argument('--quantize', '-Q', default=None, choices=QUANTIZE_TYPES,
+                        help="Dynamically quantizes the model (implies --cpu)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    threshold_margin(args.threshold)
+
+    device = get_device(args.cpu or args.quantize is not None)
+    model = EvalModel(resolve_model_path(args.model), quantize=args.quantize).to(device)
+    model.model.requires_grad_(False)
+    segmenter = Segmenter(model, batch_size=args.batch_size, max_wait=args.max_wait_ms / 1000,
+                          candidates=args.candidates, threshold=args.threshold)
+    try:
+        asyncio.run(Server(segmenter, max_body_size=args.max_body_size).serve(host=args.host, port=args.port, unix_socket=args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,18 @@
 
 import pathlib
 import os
+import math
 import torch
+import numpy as np
 import argparse
 import sys
 import csv
+import shutil
+import tempfile
+import unicodedata
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
 
 if __package__ is None and __name__ == '__main__':
     parent = pathlib.Path(__file__).absolute().parents[1]
@@ -13,11 +21,13 @@ if __package__ is None and __name__ == '__main__':
     __package__ = 'ersatz'
 
 from . import __version__
-from .utils import get_model_path, list_models, MODELS
+from .utils import get_model_path, list_models, shard_offsets, open_shard, MODELS
 from .model import ErsatzTransformer
-from .dataset import SourceFactors, split_test_file
+from .dataset import SourceFactors, context_tensor
 from .candidates import PunctuationSpace, MultilingualPunctuation, Split
 from .subword import SentencePiece
+from .export import exported_format, load_exported
+from .cache import RESULT_CACHE_PATH, CacheLookups, file_checksum, open_result_cache
 
 import logging
 
@@ -44,46 +54,103 @@ class DefaultArgs():
         self.activation_type='tanh'
 
 
-def load_model(checkpoint_path):
-    model_dict = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+QUANTIZE_TYPES = ['int8']
+
+# dynamic quantization stores the encoder feed-forward and generator weights as int8 and
+# quantizes activations on the fly; the attention projections stay fp32. Runs on CPU only
+def quantize_model(model, quantize='int8'):
+    if quantize not in QUANTIZE_TYPES:
+        raise Exception(f'Unknown quantization type {quantize}; expected one of {QUANTIZE_TYPES}')
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+# a quantized checkpoint is marked with 'quantized': the fp32 model is built, quantized the
+# same way, and then the quantized weights are loaded into it
+# TorchScript and ONNX exports (see export.py) are loaded as they are
+def load_model(checkpoint_path, quantize=None):
+    if exported_format(checkpoint_path) is not None:
+        model = load_exported(checkpoint_path)
+        if quantize is not None and quantize != model.quantized:
+            raise Exception(f'{checkpoint_path} is an exported model and cannot be quantized; export it with --quantize')
+        return model
+    model_dict = torch.load(checkpoint_path, map_location=torch.device('cpu'), weights_only=False)
     tokenizer = SentencePiece(serialization=model_dict['tokenizer'])
     model = ErsatzTransformer(tokenizer, model_dict['args'])
+    stored = model_dict.get('quantized', None)
+    if stored is not None:
+        if quantize is not None and quantize != stored:
+            raise Exception(f'{checkpoint_path} is already quantized to {stored}')
+        model = quantize_model(model, stored)
     model.load_state_dict(model_dict['weights'])
+    if stored is None and quantize is not None:
+        model = quantize_model(model, quantize)
+    model.quantized = stored or quantize
     model.eval()
     return model
 
-def detokenize(input_string):
-    input_string = input_string.replace(' ', '')
-    input_string = input_string.replace('\u2581', ' ')
-    return input_string
+def save_quantized(model, output_path):
+    model_dict = {
+        'weights': model.state_dict(),
+        'tokenizer': model.tokenizer.model.serialized_model_proto(),
+        'args': model.args,
+        'quantized': model.quantized
+    }
+    torch.save(model_dict, output_path)
 
 class EvalModel():
-    def __init__(self, model_path):
-        self.model = load_model(model_path)
+    def __init__(self, model_path, quantize=None):
+        self.model_path = model_path
+        self.model = load_model(model_path, quantize=quantize)
         if type(self.model) is torch.nn.DataParallel:
             self.model = self.model.module
+        self.quantized = self.model.quantized
 
         self.tokenizer = self.model.tokenizer
         self.left_context_size = self.model.left_context_size
         self.right_context_size = self.model.right_context_size
         self.context_size = self.right_context_size + self.left_context_size
+        self.source_factors = SourceFactors()
+        self.checksum = None
+
+    def to(self, device):
+        if self.quantized is not None and device.type != 'cpu':
+            logger.warning(f'{self.quantized} quantized models only run on CPU; ignoring {device}')
+            device = torch.device('cpu')
+        self.model = self.model.to(device)
+        self.device = device
+        return self
+
+    # encodes a line once; the pieces, ids and piece offsets are shared by
+    # context building and output reconstruction
+    def encode(self, content):
+        pieces, ids, offsets = self.tokenizer.encode_with_offsets(content)
+        text = ''.join(pieces).replace('\u2581', ' ')
+        return text, pieces, ids, offsets
+
+    # builds the (context, factors, index) rows for every candidate site in one line
+    def contexts(self, encoding, candidates):
+        text, pieces, ids, offsets = encoding
+        if len(ids) == 0:
+            return None
+        positions = candidates.scan(text, offsets, self.left_context_size, self.right_context_size)
+        if len(positions) == 0:
+            return None
+        positions = torch.tensor(positions)
+        windows = context_tensor(ids, self.left_context_size, self.right_context_size, self.tokenizer.embed_word('<pad>'))
+        indices = positions + 1
+
+        if self.model.source_factors:
+            factors = torch.tensor(self.source_factors.compute_windows(pieces, positions.tolist(),
+                                                                       self.left_context_size, self.right_context_size))
+        else:
+            factors = torch.zeros(len(positions), self.context_size, dtype=torch.long)
+        return windows[positions], factors, indices
 
-    def batchify(self, content, batch_size, candidates):
-        source_factors = SourceFactors()
-        left_contexts, right_contexts = split_test_file(content, self.tokenizer, self.left_context_size, self.right_context_size)
-        if len(left_contexts) > 0:
-            lines = []
-            indices = []
-            index = 1
-            for left, right in zip(left_contexts, right_contexts):
-                if candidates(detokenize(' '.join(left)), detokenize(' '.join(right))):
-                    lines.append((left, source_factors.compute(left),
-                                  right, source_factors.compute(right),
-                                  '<eos>'))
-                    indices.append(index)
-                index += 1
-            indices = torch.tensor(indices)
-            data, factors, _ = self.tokenizer.context_to_tensor(lines)
+    def batchify(self, content, batch_size, candidates, encoding=None):
+        if encoding is None:
+            encoding = self.encode(content)
+        rows = self.contexts(encoding, candidates)
+        if rows is not None:
+            data, factors, indices = rows
 
             nbatch = data.size(0) // batch_size
             remainder = data.size(0) % batch_size
@@ -124,81 +191,584 @@ class EvalModel():
         else:
             return []
 
-    def parallel_evaluation(self, content, batch_size, candidates=None, min_sent_length=3):
-        batches = self.batchify(content, batch_size, candidates)
+    # returns a boolean mask of the rows whose <eos> probability reaches the threshold, and with
+    # scores=True also the margins it was decided on (the <eos> log-odds, see threshold_margin)
+    def predict(self, contexts, factors, threshold=0.5, scores=False):
+        data = contexts.to(self.device)
+        if not self.model.source_factors:
+            factors = None
+        else:
+            factors = factors.to(self.device)
+
+        margin = self.model.predict(data, factors=factors, margin=True)
+        eos = (margin >= threshold_margin(threshold)).cpu()
+        if scores:
+            return eos, margin.cpu()
+        return eos
+
+    # rebuilds the line with a newline before every predicted <eos> index
+    # segments are sliced out of the encoded text at piece offsets in one pass over the sorted
+    # indices; a split is kept only if the next one is at least 5 pieces later
+    def reconstruct(self, content, encoding, eos):
+        if len(eos) == 0:
+            return content.strip()
+        text, _, _, offsets = encoding
+        eos = sorted(eos)
+        segments = []
+        start = 0
+        for position, index in enumerate(eos):
+            index = int(index)
+            if index >= len(offsets) - 1:
+                break
+            next_index = int(eos[position + 1]) if position + 1 < len(eos) else len(content)-1
+            if (next_index - index >= 5):
+                segments.append(text[offsets[start]:offsets[index]].strip())
+                start = index
+            # a repeated index was only ever visited once
+            if next_index == index:
+                break
+        segments.append(text[offsets[start]:].strip())
+        return '\n'.join(segments).strip()
+
+    # the segmentation of a line from a result cache (see cache.py) and its cache key;
+    # (None, None) without a cache. The cache is passed in by the caller, never stored on the
+    # model, since models are shared between threads (see ModelCache)
+    def lookup(self, content, candidates, threshold, cache=None):
+        if cache is None:
+            return None, None
+        if self.checksum is None:
+            self.checksum = f'{file_checksum(self.model_path)}:{self.quantized}'
+        key = cache.key(self.checksum, type(candidates).__name__, threshold, content)
+        return key, cache.get(key, content)
+
+    # reconstructs a pending line and caches it under key; a line found in the cache is
+    # pending with no encoding and its output in place of the <eos> indices
+    def finish(self, content, encoding, eos, key=None, cache=None):
+        if encoding is None:
+            return eos
+        output = self.reconstruct(content, encoding, eos)
+        if key is not None:
+            cache.put(key, content, output)
+        return output
+
+    # token indices of every candidate site predicted to be <eos>
+    # if scores is a list, the <eos> log-odds of every candidate site is appended to it in
+    # candidate order (batchify interleaves the rows of a line across batches)
+    def predict_eos(self, content, encoding, batch_size, candidates=None, threshold=0.5, scores=None):
+        batches = self.batchify(content, batch_size, candidates, encoding=encoding)
         eos = []
+        scored = []
         for contexts, factors, indices, in batches:
-            data = contexts.to(self.device)
-            if not self.model.source_factors:
-                factors = None
+            if scores is None:
+                pred = self.predict(contexts, factors, threshold=threshold)
             else:
-                factors = factors.to(self.device)
-
-            output = self.model.forward(data, factors=factors)
+                pred, margins = self.predict(contexts, factors, threshold=threshold, scores=True)
+                scored.extend(zip(indices.tolist(), margins.tolist()))
+            pred_ind = torch.where(pred)[0]
+            eos.extend(indices[pred_ind].tolist())
+        if scores is not None:
+            scores.extend(score for _, score in sorted(scored))
+        return eos
 
-            pred = output.argmax(1)
-            pred_ind = torch.where(pred == 0)[0]
-            pred_ind = [indices[i].item() for i in pred_ind]
-            eos.extend(pred_ind)
-        if len(eos) == 0:
-            yield content.strip()
-        else:
-            eos = sorted(eos)
-            next_index = int(eos.pop(0))
-            this_content = self.tokenizer.encode(content, out_type=str)
-            output = []
-            counter = 0
-            for index, word in enumerate(this_content):
-                if counter == next_index:
-                    try:
-                        next_index = int(eos.pop(0))
-                    except:
-                        next_index = len(content)-1
-                    if (next_index - counter >= 5):
-                        output.append('\n')
-                    output.append(word)
-                    
-                else:
-                    output.append(word)
-                counter += 1
-            output = self.tokenizer.merge(output, technique='utility').strip().split('\n')
-            yield '\n'.join([o.strip() for o in output])
+    def parallel_evaluation(self, content, batch_size, candidates=None, min_sent_length=3, threshold=0.5, scores=None):
+        encoding = self.encode(content)
+        eos = self.predict_eos(content, encoding, batch_size, candidates=candidates, threshold=threshold, scores=scores)
+        yield self.reconstruct(content, encoding, eos)
         yield None
 
-    def split(self, input_file, output_file, batch_size, candidates=None):
-        for line in input_file:
-            for batch_output in self.parallel_evaluation(line, batch_size, candidates=candidates):
+    # scores_file receives one line of candidate <eos> log-odds per input line (see format_scores)
+    # with stream, lines longer than that many characters are segmented by split_stream
+    # with a result cache, lines are looked up before they are tokenized (except with scores_file)
+    def split(self, input_file, output_file, batch_size, candidates=None, pack=False, threshold=0.5, scores_file=None,
+              stream=None, cache=None):
+        if pack:
+            return self.split_packed(input_file, output_file, batch_size, candidates=candidates,
+                                     threshold=threshold, scores_file=scores_file, stream=stream, cache=cache)
+        for line in read_lines(input_file, stream):
+            if not isinstance(line, str):
+                self.split_stream(line, output_file, batch_size, candidates=candidates,
+                                  threshold=threshold, scores_file=scores_file)
+                continue
+            scores = [] if scores_file is not None else None
+            key, cached = self.lookup(line, candidates, threshold, cache) if scores is None else (None, None)
+            if cached is not None:
+                print(cached, file=output_file)
+                continue
+            for batch_output in self.parallel_evaluation(line, batch_size, candidates=candidates,
+                                                         threshold=threshold, scores=scores):
                 if batch_output is not None:
                     print(batch_output.strip(), file=output_file)
+                    if key is not None:
+                        cache.put(key, line, batch_output)
+            if scores_file is not None:
+                print(format_scores(scores), file=scores_file)
         return output_file
 
+    # packs candidate sites from consecutive lines into full batches
+    # rows remember their line and token index so lines are written back in input order
+    # a streamed line first flushes everything before it
+    def split_packed(self, input_file, output_file, batch_size, candidates=None, threshold=0.5, scores_file=None,
+                     stream=None, cache=None):
+        pending = {}
+        next_line = 0
+        buffer = []
+        buffered = 0
+        for line_number, line in enumerate(read_lines(input_file, stream)):
+            if not isinstance(line, str):
+                if buffered > 0:
+                    self.run_packed(buffer, batch_size, pending, final=True, threshold=threshold,
+                                    scores=scores_file is not None)
+                    buffer = []
+                    buffered = 0
+                self.write_finished(pending, next_line, output_file, scores_file=scores_file, cache=cache)
+                self.split_stream(line, output_file, batch_size, candidates=candidates,
+                                  threshold=threshold, scores_file=scores_file)
+                next_line = line_number + 1
+                continue
+            key, cached = self.lookup(line, candidates, threshold, cache) if scores_file is None else (None, None)
+            if cached is not None:
+                pending[line_number] = [line, None, cached, 0, [], None]
+                next_line = self.write_finished(pending, next_line, output_file, scores_file=scores_file, cache=cache)
+                continue
+            encoding = self.encode(line)
+            rows = self.contexts(encoding, candidates)
+            if rows is None:
+                pending[line_number] = [line, encoding, [], 0, [], key]
+            else:
+                data, factors, indices = rows
+                pending[line_number] = [line, encoding, [], data.size(0), [], key]
+                buffer.append((data, factors, indices, torch.full_like(indices, line_number)))
+                buffered += data.size(0)
+            if buffered >= batch_size:
+                buffer = self.run_packed(buffer, batch_size, pending, threshold=threshold,
+                                         scores=scores_file is not None)
+                buffered = buffer[0][0].size(0) if len(buffer) > 0 else 0
+            next_line = self.write_finished(pending, next_line, output_file, scores_file=scores_file, cache=cache)
+        if buffered > 0:
+            self.run_packed(buffer, batch_size, pending, final=True, threshold=threshold,
+                            scores=scores_file is not None)
+        self.write_finished(pending, next_line, output_file, scores_file=scores_file, cache=cache)
+        return output_file
+
+    # segments one line given as an iterator over blocks of it (see read_lines) while keeping only
+    # a window of it in memory. Blocks are tokenized separately, cut at whitespace so the pieces are
+    # the same as for the whole line, and a candidate site is predicted once the right_context_size
+    # pieces after it are known. A split is written once the next <eos>, or the distance already
+    # scanned without one, settles the minimum length rule of reconstruct. Like reconstruct, a line
+    # without any <eos> is written as it was read; until the first <eos> is predicted both forms are
+    # spooled to temporary files.
+    # Text without whitespace (unsegmented scripts, long URLs) is cut by force once more than
+    # STREAM_MAX_WORD characters are waiting (see forced_cut). The piece after such a cut loses the
+    # word-initial marker sentencepiece gives it, but the pieces around the cut can still differ
+    # from those of the whole line, so splits near it may differ from a run without --stream
+    def split_stream(self, blocks, output_file, batch_size, candidates=None, threshold=0.5, scores_file=None):
+        spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+        raw_spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+        writer = SegmentWriter(spool)
+        raw_writer = SegmentWriter(raw_spool)
+        raw = ''
+        chars = 0
+        continued = False  # raw starts in the middle of a word cut by forced_cut
+        pieces, ids, offsets, text = [], [], [0], ''
+        base = 0        # line index of pieces[0]
+        done = 0        # candidate sites of the pieces before this one have been predicted
+        flushed = 0     # the text of the pieces before this one has been written
+        eos = deque()
+        scored = 0
+
+        blocks = iter(blocks)
+        block = next(blocks, None)
+        while block is not None:
+            following = next(blocks, None)
+            final = following is None
+            raw += block
+            chars += len(block)
+            if raw_writer is not None:
+                raw_writer.write(block)
+
+            # the unfinished word at the end waits for the next block. raw held no whitespace past
+            # its first character before this block, so only the block is searched
+            cut = len(raw)
+            forced = False
+            if not final:
+                cut -= 1
+                start = max(len(raw) - len(block), 1)
+                while cut >= start and not raw[cut].isspace():
+                    cut -= 1
+                if cut < start:
+                    cut = 0
+                    if len(raw) > STREAM_MAX_WORD:
+                        cut = forced_cut(raw, candidates)
+                        forced = True
+            new_pieces, new_ids, _ = self.tokenizer.encode_with_offsets(raw[:cut])
+            if continued and len(new_pieces) > 0 and new_pieces[0].startswith('\u2581'):
+                if new_pieces[0] == '\u2581':
+                    new_pieces, new_ids = new_pieces[1:], new_ids[1:]
+                else:
+                    new_pieces[0] = new_pieces[0][1:]
+            if cut > 0:
+                continued = forced
+            raw = raw[cut:]
+            for piece in new_pieces:
+                offsets.append(offsets[-1] + len(piece))
+            pieces += new_pieces
+            ids += new_ids
+            text += ''.join(new_pieces).replace('\u2581', ' ')
+            total = base + len(pieces)
+
+            limit = total if final else total - self.right_context_size
+            if limit > done:
+                region = max(done - self.left_context_size, base) - base
+                encoding = (text[offsets[region]:], pieces[region:], ids[region:],
+                            [offset - offsets[region] for offset in offsets[region:]])
+                rows = self.contexts(encoding, candidates)
+                if rows is not None:
+                    data, factors, indices = rows
+                    # indices are positions + 1, in line order
+                    keep = (indices + base + region > done) & (indices + base + region <= limit)
+                    data, factors, indices = data[keep], factors[keep], indices[keep] + base + region
+                    for batch in range(0, data.size(0), batch_size):
+                        if scores_file is None:
+                            pred = self.predict(data[batch:batch+batch_size], factors[batch:batch+batch_size],
+                                                threshold=threshold)
+                        else:
+                            pred, margins = self.predict(data[batch:batch+batch_size],
+                                                               factors[batch:batch+batch_size],
+                                                               threshold=threshold, scores=True)
+                            if len(margins) > 0:
+                                print(('' if scored == 0 else ' ') + format_scores(margins.tolist()),
+                                      end='', file=scores_file)
+                                scored += len(margins)
+                        eos.extend(indices[batch:batch+batch_size][pred].tolist())
+                done = limit
+
+            if raw_writer is not None and len(eos) > 0:
+                spool.seek(0)
+                shutil.copyfileobj(spool, output_file)
+                writer.output_file = output_file
+                spool.close()
+                raw_spool.close()
+                raw_writer = None
+
+            # the minimum length rule of reconstruct, decided as early as possible
+            while len(eos) > 0:
+                index = eos[0]
+                if index >= total and final:
+                    eos.clear()
+                    break
+                if len(eos) > 1:
+                    next_index = eos[1]
+                elif final:
+                    next_index = chars - 1
+                elif done + 1 - index >= 5 and chars - 1 - index >= 5:
+                    next_index = index + 5
+                else:
+                    break
+                eos.popleft()
+                if next_index - index >= 5:
+                    writer.write(text[offsets[flushed - base]:offsets[index - base]])
+                    writer.end()
+                    flushed = index
+
+            # the text up to the next possible split belongs to the current segment
+            safe = total if final else min(eos[0] if len(eos) > 0 else done + 1, total)
+            if safe > flushed:
+                writer.write(text[offsets[flushed - base]:offsets[safe - base]])
+                flushed = safe
+
+            drop = max(min(flushed, done - self.left_context_size), base) - base
+            if drop > 0:
+                text = text[offsets[drop]:]
+                offsets = [offset - offsets[drop] for offset in offsets[drop:]]
+                pieces = pieces[drop:]
+                ids = ids[drop:]
+                base += drop
+            block = following
+
+        if raw_writer is not None:
+            raw_writer.close()
+            raw_spool.seek(0)
+            shutil.copyfileobj(raw_spool, output_file)
+            spool.close()
+            raw_spool.close()
+        else:
+            writer.end()
+            writer.close()
+        if scores_file is not None:
+            print('', file=scores_file)
+
+    # predicts every full batch in the buffer and returns the leftover rows
+    def run_packed(self, buffer, batch_size, pending, final=False, threshold=0.5, scores=False):
+        data, factors, indices, line_numbers = [torch.cat(column) for column in zip(*buffer)]
+        total = data.size(0)
+        if not final:
+            total = (total // batch_size) * batch_size
+        for start in range(0, total, batch_size):
+            end = min(start + batch_size, total)
+            if scores:
+                eos, margins = self.predict(data[start:end], factors[start:end], threshold=threshold, scores=True)
+                margins = margins.tolist()
+            else:
+                eos = self.predict(data[start:end], factors[start:end], threshold=threshold)
+            for row, (line_number, index, is_eos) in enumerate(zip(line_numbers[start:end].tolist(),
+                                                                   indices[start:end].tolist(), eos.tolist())):
+                entry = pending[line_number]
+                entry[3] -= 1
+                if scores:
+                    entry[4].append(margins[row])
+                if is_eos:
+                    entry[2].append(index)
+        if total == data.size(0):
+            return []
+        return [(data[total:], factors[total:], indices[total:], line_numbers[total:])]
+
+    def write_finished(self, pending, next_line, output_file, scores_file=None, cache=None):
+        while next_line in pending and pending[next_line][3] == 0:
+            content, encoding, eos, _, scores, key = pending.pop(next_line)
+            print(self.finish(content, encoding, eos, key, cache).strip(), file=output_file)
+            if scores_file is not None:
+                print(format_scores(scores), file=scores_file)
+            next_line += 1
+        return next_line
 
-    def split_delimiter(self, input_file, output_file, batch_size, delimiter, columns, candidates=None):
+    # the selected columns of consecutive rows are packed into shared batches the same way as
+    # split_packed, with one pending entry per cell; rows are written back in input order, each
+    # split column one sentence per line and the other columns repeated next to them
+    # with a scores_file, each row gets one line holding the scores of its split columns, tab separated
+    def split_delimiter(self, input_file, output_file, batch_size, delimiter, columns, candidates=None,
+                        threshold=0.5, scores_file=None, cache=None):
         input_file = csv.reader(input_file, delimiter=delimiter)
+        pending = {}
+        rows = deque()
+        cells = 0
+        buffer = []
+        buffered = 0
         for line in input_file:
+            row_cells = {}
+            for i, l in enumerate(line):
+                if i in columns:
+                    key, cached = self.lookup(l, candidates, threshold, cache) if scores_file is None else (None, None)
+                    if cached is not None:
+                        pending[cells] = [l, None, cached, 0, [], None]
+                        row_cells[i] = cells
+                        cells += 1
+                        continue
+                    encoding = self.encode(l)
+                    cell_rows = self.contexts(encoding, candidates)
+                    if cell_rows is None:
+                        pending[cells] = [l, encoding, [], 0, [], key]
+                    else:
+                        data, factors, indices = cell_rows
+                        pending[cells] = [l, encoding, [], data.size(0), [], key]
+                        buffer.append((data, factors, indices, torch.full_like(indices, cells)))
+                        buffered += data.size(0)
+                    row_cells[i] = cells
+                    cells += 1
+            rows.append((line, row_cells))
+            if buffered >= batch_size:
+                buffer = self.run_packed(buffer, batch_size, pending, threshold=threshold,
+                                         scores=scores_file is not None)
+                buffered = buffer[0][0].size(0) if len(buffer) > 0 else 0
+            self.write_finished_rows(rows, pending, output_file, delimiter, scores_file=scores_file, cache=cache)
+        if buffered > 0:
+            self.run_packed(buffer, batch_size, pending, final=True, threshold=threshold,
+                            scores=scores_file is not None)
+        self.write_finished_rows(rows, pending, output_file, delimiter, scores_file=scores_file, cache=cache)
+        return output_file
+
+    def write_finished_rows(self, rows, pending, output_file, delimiter, scores_file=None, cache=None):
+        while len(rows) > 0 and all(pending[cell][3] == 0 for cell in rows[0][1].values()):
+            line, row_cells = rows.popleft()
             new_lines = []
+            row_scores = []
             max_len = 1
             for i, l in enumerate(line):
-                if i in columns:
-                    for batch_output in self.parallel_evaluation(l, batch_size, candidates=candidates):
-                        if batch_output is not None:
-                            batch_output = batch_output.split('\n')
-                            new_lines.append(batch_output)
-                            if len(batch_output) > max_len:
-                                max_len = len(batch_output)
+                if i in row_cells:
+                    content, encoding, eos, _, scores, key = pending.pop(row_cells[i])
+                    batch_output = self.finish(content, encoding, eos, key, cache).split('\n')
+                    new_lines.append(batch_output)
+                    if len(batch_output) > max_len:
+                        max_len = len(batch_output)
+                    row_scores.append(format_scores(scores))
                 else:
                     new_lines.append([line[i]])
             for x in range(max_len):
                 out_line = []
                 for i, col in enumerate(new_lines):
                     if x >= len(col):
-                        if i not in columns:
+                        if i not in row_cells:
                             out_line.append(col[-1])
                         else:
                             out_line.append('')
                     else:
                         out_line.append(col[x])
                 print(delimiter.join(out_line).strip(), file=output_file)
+            if scores_file is not None:
+                print('\t'.join(row_scores), file=scores_file)
+
+    # re-splits lines from the scores written by a previous run with --emit-scores, without
+    # running the model; only the tokenizer and the candidate scan are needed
+    def split_scored(self, input_file, scores_file, output_file, candidates=None, threshold=0.5):
+        for line_number, (line, scores) in enumerate(zip(input_file, scores_file)):
+            encoding = self.encode(line)
+            text, pieces, ids, offsets = encoding
+            positions = candidates.scan(text, offsets, self.left_context_size, self.right_context_size) if len(ids) > 0 else []
+            scores = parse_scores(scores)
+            margin = np.float32(threshold_margin(threshold))
+            if len(scores) != len(positions):
+                raise Exception(f'Line {line_number+1} has {len(positions)} candidate sites but {len(scores)} scores; '
+                                'the scores must come from the same input, model and --candidates')
+            eos = [position + 1 for position, score in zip(positions, scores) if score >= margin]
+            print(self.reconstruct(line, encoding, eos).strip(), file=output_file)
+        return output_file
+
+STREAM_CHUNK_SIZE = 1 << 16
+# characters without whitespace split_stream waits for before it cuts them by force
+STREAM_MAX_WORD = 1 << 12
+
+# where to cut raw text that has no whitespace: after the last run of candidate punctuation that
+# is followed by more text, otherwise before the last character (kept with its combining marks)
+def forced_cut(raw, candidates):
+    runs = getattr(candidates, 'runs', None)
+    cut = 0
+    if runs is not None:
+        for offset, _ in runs(raw):
+            if offset < len(raw):
+                cut = offset
+    if cut == 0:
+        cut = len(raw) - 1
+        while cut > 1 and unicodedata.combining(raw[cut]):
+            cut -= 1
+    return cut
+
+# writes the segments of a streamed line the way reconstruct joins them: each segment stripped,
+# one per line, without the empty segments at either end
+class SegmentWriter():
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.written = 0
+        self.empty = 0
+        self.open = False
+        self.space = ''
+
+    # appends text to the current segment; trailing whitespace is held back until more text follows
+    def write(self, text):
+        if not self.open:
+            text = text.lstrip()
+            if text == '':
+                return
+            if self.written > 0:
+                self.output_file.write('\n' * (self.empty + 1))
+            self.empty = 0
+            self.written += 1
+            self.open = True
+        stripped = text.rstrip()
+        if stripped == '':
+            self.space += text
+            return
+        self.output_file.write(self.space + stripped)
+        self.space = text[len(stripped):]
+
+    def end(self):
+        if not self.open and self.written > 0:
+            self.empty += 1
+        self.open = False
+        self.space = ''
+
+    def close(self):
+        self.output_file.write('\n')
+
+# yields the lines of input_file; with chunk_size, a line longer than that comes as an iterator
+# over blocks of at most chunk_size characters instead, the last of which ends the line
+def read_lines(input_file, chunk_size=None):
+    if chunk_size is None or not hasattr(input_file, 'readline'):
+        yield from input_file
+        return
+    while True:
+        block = input_file.readline(chunk_size)
+        if block == '':
+            return
+        if len(block) < chunk_size or block.endswith('\n'):
+            yield block
+            continue
+        blocks = line_blocks(input_file, block, chunk_size)
+        yield blocks
+        # the rest of the line is skipped if the consumer stopped early
+        for _ in blocks:
+            pass
+
+def line_blocks(input_file, block, chunk_size):
+    yield block
+    while not block.endswith('\n'):
+        block = input_file.readline(chunk_size)
+        if block == '':
+            return
+        yield block
+
+# the decision rule P(<eos>) >= threshold as a bound on the <eos>-minus-<mos> score;
+# 0.5 gives 0, the argmax
+def threshold_margin(threshold):
+    if not 0 < threshold < 1:
+        raise Exception(f'--threshold must be between 0 and 1, got {threshold}')
+    return math.log(threshold / (1 - threshold))
+
+# candidate <eos> log-odds of one line, in the order of the candidate sites. These are the float32
+# margins predict() compares to threshold_margin(), written with enough digits to be read back
+# exactly, so re-splitting at the same threshold reproduces the live run
+def format_scores(scores):
+    return ' '.join('%.9g' % score for score in scores)
+
+def parse_scores(line):
+    return np.array(line.split(), dtype=np.float32)
+
+def get_device(cpu=False):
+    if torch.cuda.is_available() and not cpu:
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+def resolve_model_path(model_name):
+    if model_name not in MODELS:
+        return model_name
+    return get_model_path(model_name)
+
+# process-wide cache of loaded models so that repeated calls to the python api
+# only pay for inference and not for torch.load/sentencepiece/device transfer
+class ModelCache():
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.models)
+
+    def key(self, model_name, device, candidates, quantize=None):
+        return (resolve_model_path(model_name), str(device), candidates, quantize)
+
+    def get(self, model_name, device, candidates='multilingual', quantize=None):
+        key = self.key(model_name, device, candidates, quantize)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            logger.debug(f'Loading {key[0]} onto {key[1]}')
+            model = EvalModel(key[0], quantize=quantize).to(device)
+            self.models[key] = model
+            while len(self.models) > max(self.max_size, 1):
+                evicted, _ = self.models.popitem(last=False)
+                logger.debug(f'Evicting {evicted[0]} from {evicted[1]}')
+            return model
+
+    def unload(self, model_name, device, candidates='multilingual', quantize=None):
+        key = self.key(model_name, device, candidates, quantize)
+        with self.lock:
+            return self.models.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+MODEL_CACHE = ModelCache()
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -223,6 +793,44 @@ def parse_args():
                                "   * en: [EOS punctuation][any_punctuation]*[space] (sentence-ending punctuation followed by a space)\n"
                                "   * all: all possible contexts")
     main_group.add_argument('--cpu', action='store_true', help="Uses CPU (GPU is default if available)")
+    main_group.add_argument('--pack', action='store_true',
+                        help="Packs candidate sites from many lines into full batches (faster on one-sentence-per-line input)")
+    main_group.add_argument('--workers', '-w', type=int, default=1,
+                        help="Number of processes to split '--input' with (each loads its own copy of the model)")
+    main_group.add_argument('--stream', type=int, nargs='?', const=STREAM_CHUNK_SIZE, default=None, metavar='CHARS',
+                        help="Segments lines longer than CHARS characters (default %d) in overlapping windows,\n"
+                             "writing sentences as they are found and keeping memory bounded (plain-text mode)" % STREAM_CHUNK_SIZE)
+
+    scores_group = parser.add_argument_group('score options')
+    scores_group.add_argument('--threshold', '-t', type=float, default=0.5,
+                        help="Minimum <eos> probability to split at (default 0.5).\n"
+                             "  * higher values trade recall for precision")
+    scores_group.add_argument('--emit-scores', default=None, metavar='PATH',
+                        help="Writes the <eos> log-odds of every candidate site to PATH (P(<eos>) = 1 / (1 + exp(-score))),\n"
+                             "one line of space-separated scores per input line (tab-separated columns with '--columns')")
+    scores_group.add_argument('--scores', default=None, metavar='PATH',
+                        help="Splits '--input' at '--threshold' using scores written by '--emit-scores',\n"
+                             "without running the model. '--model' and '--candidates' must match the scoring run")
+
+    quantize_group = parser.add_argument_group('quantization options')
+    quantize_group.add_argument('--quantize', '-Q', default=None, choices=QUANTIZE_TYPES,
+                        help="Dynamically quantizes the model's linear layers for faster CPU inference (implies --cpu)")
+    quantize_group.add_argument('--save-quantized', default=None, metavar='PATH',
+                        help="Writes the model quantized with '--quantize' to PATH and exits.\n"
+                             "  * the file can be passed to '--model' directly")
+    quantize_group.add_argument('--quantize-check', action='store_true',
+                        help="Reports the segmentation F1 of the model quantized with '--quantize' against\n"
+                             "the fp32 model on '--input' (or stdin) and exits")
+
+    cache_group = parser.add_argument_group('result cache options')
+    cache_group.add_argument('--result-cache', default=None, nargs='?', const=RESULT_CACHE_PATH, metavar='PATH',
+                        help="Caches the segmentation of every line in a sqlite file (default %s)\n"
+                             "and reuses it for repeated lines without running the model.\n"
+                             "  * not used for lines with '--emit-scores' or streamed lines" % RESULT_CACHE_PATH)
+    cache_group.add_argument('--result-cache-size', type=int, default=1024, metavar='MB',
+                        help="Size of the result cache file before the least recently used lines are evicted (default 1024)")
+    cache_group.add_argument('--result-cache-memory', type=int, default=100000, metavar='LINES',
+                        help="Number of lines kept in memory in front of the result cache file (default 100000)")
 
     tsv_group = parser.add_argument_group('tsv options', description="Used for splitting .csv/.tsv/etc files. This mode triggered by '--columns'")
     tsv_group.add_argument('--delimiter', '-d', type=str, default='\t',
@@ -248,15 +856,114 @@ def parse_args():
 
     return args
 
-def split(args):
-    if args.candidates == "en":
-        candidates = PunctuationSpace()
-    elif args.candidates == 'multilingual':
-        candidates = MultilingualPunctuation()
+def load_candidates(name):
+    if name == "en":
+        return PunctuationSpace()
+    elif name == 'multilingual':
+        return MultilingualPunctuation()
     else:
-        candidates = Split()
+        return Split()
+
+# (path, max_bytes, memory_size) of the result cache requested by args, or None
+def result_cache_options(args):
+    path = getattr(args, 'result_cache', None)
+    if path is None or path is False:
+        return None
+    if path is True:
+        path = RESULT_CACHE_PATH
+    return (path, getattr(args, 'result_cache_size', 1024) << 20, getattr(args, 'result_cache_memory', 100000))
+
+def open_cache(options):
+    if options is None:
+        return None
+    path, max_bytes, memory_size = options
+    return open_result_cache(path, max_bytes=max_bytes, memory_size=memory_size)
+
+worker_model = None
+worker_cache = None
+
+def init_worker(model_path, cpu, threads, quantize=None, cache_options=None):
+    global worker_model, worker_cache
+    torch.set_num_threads(threads)
+    device = get_device(cpu)
+    if device.type == 'cuda':
+        rank = multiprocessing.current_process()._identity[0] - 1
+        device = torch.device('cuda', rank % torch.cuda.device_count())
+    worker_model = EvalModel(model_path, quantize=quantize).to(device)
+    worker_model.model.requires_grad_(False)
+    worker_cache = open_cache(cache_options)
+
+def split_shard(shard):
+    (input_path, start, end, batch_size, candidates, pack, threshold, emit_scores, stream, delimiter, columns,
+     staging) = shard
+    output = tempfile.NamedTemporaryFile('w', prefix='ersatz.', suffix='.shard', dir=staging, delete=False)
+    scores = None
+    if emit_scores:
+        scores = tempfile.NamedTemporaryFile('w', prefix='ersatz.', suffix='.scores', dir=staging, delete=False)
+    with output, open_shard(input_path, start, end) as input_file:
+        with torch.no_grad():
+            if columns is None:
+                worker_model.split(input_file, output, batch_size, candidates=load_candidates(candidates), pack=pack,
+                                   threshold=threshold, scores_file=scores, stream=stream, cache=worker_cache)
+            else:
+                worker_model.split_delimiter(input_file, output, batch_size, delimiter, columns,
+                                             candidates=load_candidates(candidates), threshold=threshold,
+                                             scores_file=scores, cache=worker_cache)
+    if worker_cache is not None:
+        worker_cache.flush()
+    if scores is not None:
+        scores.close()
+        return output.name, scores.name
+    return output.name, None
+
+def append_shard(shard_output, output_file):
+    with open(shard_output) as shard_file:
+        shutil.copyfileobj(shard_file, output_file)
+    os.remove(shard_output)
+
+# splits --input on several processes, each with its own copy of the model, and
+# concatenates the shard outputs in order so the result matches a single process run.
+# shard outputs are staged in a directory of their own that is removed even if a worker fails
+def split_sharded(args, output_file, workers, scores_file=None):
+    offsets = shard_offsets(args.input, workers * 4)
+    staging = tempfile.mkdtemp(prefix='ersatz.')
+    shards = [(args.input, start, end, args.batch_size, args.candidates, getattr(args, 'pack', False),
+               getattr(args, 'threshold', 0.5), scores_file is not None, getattr(args, 'stream', None),
+               args.delimiter, args.columns, staging)
+              for start, end in zip(offsets[:-1], offsets[1:])]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(min(workers, len(shards)), initializer=init_worker,
+                          initargs=(resolve_model_path(args.model), args.cpu, threads,
+                                    getattr(args, 'quantize', None), result_cache_options(args))) as pool:
+            for shard_output, shard_scores in pool.imap(split_shard, shards):
+                append_shard(shard_output, output_file)
+                if shard_scores is not None:
+                    append_shard(shard_scores, scores_file)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    output_file.flush()
+    return output_file
+
+def split(args):
+    candidates = load_candidates(args.candidates)
+    threshold = getattr(args, 'threshold', 0.5)
+    threshold_margin(threshold)
+    emit_scores = getattr(args, 'emit_scores', None)
+    rescore = getattr(args, 'scores', None)
+    if rescore is not None and (emit_scores is not None or args.columns is not None):
+        raise Exception("'--scores' only works on plain text and cannot be combined with '--emit-scores'")
+
+    workers = getattr(args, 'workers', 1)
+    if workers > 1 and (args.input is None or rescore is not None):
+        logger.warning('--workers requires --input; running on a single process')
+        workers = 1
+
+    if getattr(args, 'stream', None) is not None and (args.columns is not None or rescore is not None):
+        logger.warning("--stream only applies to plain-text segmentation; lines are read whole")
 
-    if args.input is not None:
+    if args.input is not None and workers <= 1:
         input_file = open(args.input, 'r')
     elif args.text is not None:
         input_file = args.text.split('\n')
@@ -271,28 +978,104 @@ def split(args):
     else:
         output_file = sys.stdout
 
-    if torch.cuda.is_available() and not args.cpu:
-        device = torch.device('cuda')
-    else:
-        device = torch.device('cpu')
+    # the python api passes emit_scores=True to get the scores back with the text
+    scores_file = None
+    if emit_scores is True:
+        from io import StringIO
+        scores_file = StringIO()
+    elif emit_scores is not None:
+        scores_file = open(emit_scores, 'w')
 
-    if args.model not in MODELS:
-        model = EvalModel(args.model)
-    else:
-        model_path = get_model_path(args.model)
-        model = EvalModel(model_path)
+    if workers > 1:
+        split_sharded(args, output_file, workers, scores_file=scores_file)
+        return split_result(args, output_file, scores_file)
 
-    model.model = model.model.to(device)
-    model.device = device
+    quantize = getattr(args, 'quantize', None)
+    device = get_device(args.cpu or quantize is not None)
+
+    if getattr(args, 'cache', False):
+        model = MODEL_CACHE.get(args.model, device, args.candidates, quantize=quantize)
+    else:
+        model = EvalModel(resolve_model_path(args.model), quantize=quantize).to(device)
+    cache = open_cache(result_cache_options(args))
+    if cache is not None:
+        cache = CacheLookups(cache)
 
     with torch.no_grad():
+        if rescore is not None:
+            with open(rescore) as rescore_file:
+                output_file = model.split_scored(input_file, rescore_file, output_file, candidates=candidates,
+                                                 threshold=threshold)
+        elif args.columns is None:
+            output_file = model.split(input_file, output_file, args.batch_size, candidates=candidates,
+                                      pack=getattr(args, 'pack', False), threshold=threshold, scores_file=scores_file,
+                                      stream=getattr(args, 'stream', None), cache=cache)
+        else:
+            output_file = model.split_delimiter(input_file, output_file, args.batch_size, args.delimiter, args.columns,
+                                                candidates=candidates, threshold=threshold, scores_file=scores_file,
+                                                cache=cache)
+
+    if cache is not None:
+        cache.flush()
+        lookups = cache.hits + cache.misses
+        if lookups > 0:
+            logger.info(f'Result cache: {cache.hits} of {lookups} lines found ({cache.hits / lookups * 100:.1f}%)')
+
+    return split_result(args, output_file, scores_file)
+
+# with text input the segments are returned, together with one array of candidate
+# log-odds per input line (one per split column for tsv) if scores were requested
+def split_result(args, output_file, scores_file):
+    if scores_file is not None and scores_file is not sys.stdout:
+        scores_file.flush()
+    if not args.text:
+        return
+    segments = output_file.getvalue().strip().split('\n')
+    if getattr(args, 'emit_scores', None) is not True:
+        return segments
+    scores = []
+    for line in scores_file.getvalue().split('\n')[:-1]:
         if args.columns is None:
-            output_file = model.split(input_file, output_file, args.batch_size, candidates=candidates)
+            scores.append(parse_scores(line))
         else:
-            output_file = model.split_delimiter(input_file, output_file, args.batch_size, args.delimiter, args.columns, candidates=candidates)
+            scores.append([parse_scores(column) for column in line.split('\t')])
+    return segments, scores
+
+# compares the <eos> decisions of the quantized model to the fp32 model at every candidate site,
+# treating the fp32 decisions as the reference
+def quantize_check(args):
+    candidates = load_candidates(args.candidates)
+    model_path = resolve_model_path(args.model)
+    device = torch.device('cpu')
+    reference = EvalModel(model_path).to(device)
+    if reference.quantized is not None:
+        raise Exception(f'{model_path} is already quantized; --quantize-check needs the fp32 model')
+    quantized = EvalModel(model_path, quantize=args.quantize).to(device)
+
+    input_file = open(args.input, 'r') if args.input is not None else sys.stdin
+    agree = only_reference = only_quantized = 0
+    lines = changed = 0
+    with torch.no_grad():
+        for line in input_file:
+            encoding = reference.encode(line)
+            expected = set(reference.predict_eos(line, encoding, args.batch_size, candidates=candidates))
+            found = set(quantized.predict_eos(line, encoding, args.batch_size, candidates=candidates))
+            agree += len(expected & found)
+            only_reference += len(expected - found)
+            only_quantized += len(found - expected)
+            lines += 1
+            if reference.reconstruct(line, encoding, list(expected)) != quantized.reconstruct(line, encoding, list(found)):
+                changed += 1
 
-    if args.text:
-        return output_file.getvalue().strip().split('\n')
+    precision = agree / (agree + only_quantized) if agree + only_quantized > 0 else 1.0
+    recall = agree / (agree + only_reference) if agree + only_reference > 0 else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    print(f'{args.quantize} vs fp32 on {lines} lines: {agree} shared splits, '
+          f'{only_reference} dropped, {only_quantized} added, {changed} lines changed')
+    print(f'Precision {precision*100:.2f}')
+    print(f'Recall {recall*100:.2f}')
+    print(f'F1 {f1*100:.2f}')
+    return f1
 
 def main():
 
@@ -314,6 +1097,18 @@ def main():
     if args.quiet:
         logger.setLevel(logging.ERROR)
 
+    if (args.save_quantized is not None or args.quantize_check) and args.quantize is None:
+        raise Exception("'--save-quantized' and '--quantize-check' require '--quantize'")
+
+    if args.save_quantized is not None:
+        model = EvalModel(resolve_model_path(args.model), quantize=args.quantize)
+        save_quantized(model.model, args.save_quantized)
+        sys.exit(0)
+
+    if args.quantize_check:
+        quantize_check(args)
+        sys.exit(0)
+
     split(args)
 
 if __name__ == '__main__':
@@ -1,6 +1,14 @@
 # *-* coding: utf-8 *-*
+import hashlib
 import torch
 
+# character offset of every piece boundary in ''.join(pieces)
+def piece_offsets(pieces):
+    offsets = [0]
+    for p in pieces:
+        offsets.append(offsets[-1] + len(p))
+    return offsets
+
 class Vocabulary():
 
     def __init__(self):
@@ -27,6 +35,9 @@ class Vocabulary():
     def get_word(self, embedding):
         return self.itos[embedding]
 
+    def checksum(self):
+        return hashlib.md5('\n'.join(self.itos).encode('utf-8')).hexdigest()
+
     def detokenize(self, input_string):
         input_string = input_string.replace(' ', '')
         input_string = input_string.replace('\u2581', ' ')
@@ -42,6 +53,13 @@ class Vocabulary():
         else:
             return input_string.split()
 
+    # encodes once and returns the joined pieces, their ids, and the character
+    # offset of every piece boundary in the joined string
+    def encode_with_offsets(self, input_string):
+        pieces = self.encode(input_string, out_type=str)
+        ids = [self.embed_word(p) for p in pieces]
+        return pieces, ids, piece_offsets(pieces)
+
     def decode(self, input_array):
         output = []
         for i in input_array:
@@ -103,6 +121,12 @@ class SentencePiece(Vocabulary):
     def embed_word(self, word):
         return self.model[word]
 
+    def get_word(self, embedding):
+        return self.model.id_to_piece(embedding)
+
+    def checksum(self):
+        return hashlib.md5(self.model.serialized_model_proto()).hexdigest()
+
     def encode(self, sentence, out_type=int) -> str:
         return self.model.encode(sentence, out_type=out_type)
         if out_type is int:
@@ -3,6 +3,8 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.distributed.algorithms.join import Join
 import argparse
 import os
 import logging
@@ -10,6 +12,11 @@ import math
 import json
 import sys
 import pathlib
+import contextlib
+import threading
+import queue
+import random
+import numpy as np
 
 
 if __package__ is None and __name__ == '__main__':
@@ -107,35 +114,128 @@ class Results():
 
 
 def load_model(checkpoint_path):
-    model_dict = torch.load(checkpoint_path)
+    model_dict = torch.load(checkpoint_path, weights_only=False)
     model = ErsatzTransformer(model_dict['vocab'], model_dict['args'])
     model.load_state_dict(model_dict['weights'])
 
     return model
 
-def save_model(model, output_path):
-    model = model.cpu()
-    model_dict = {
-        'weights': model.state_dict(),
-        'tokenizer': open(model.tokenizer.model_path, 'rb').read(),
-        'args': model.args
+# a cpu copy of the weights; the model itself stays where it is
+def snapshot_weights(model):
+    weights = model.state_dict()
+    for name in weights:
+        weights[name] = weights[name].detach().to('cpu', copy=True)
+    return weights
+
+# a cpu copy of (nested) state dicts, e.g. the optimizer state
+def snapshot_state(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot_state(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return state
+
+def rng_state():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
     }
-    torch.save(model_dict, output_path)
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# saves checkpoints without stopping training: the weights are snapshotted on the calling thread,
+# then written by a background thread to a temp file that is renamed into place, so a checkpoint
+# file is always complete. Only the last `keep` epoch checkpoints are kept (0 keeps all)
+class CheckpointWriter():
+    def __init__(self, tokenizer_path, keep=0):
+        with open(tokenizer_path, 'rb') as f:
+            self.tokenizer = f.read()
+        self.keep = keep
+        self.epoch_paths = []
+        self.error = None
+        # at most two snapshots wait in memory; save() blocks beyond that
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # training (see ErsatzTrainer.training_state) makes the checkpoint resumable
+    def save(self, model, output_path, epoch_checkpoint=False, training=None):
+        self.check()
+        model_dict = {
+            'weights': snapshot_weights(model),
+            'tokenizer': self.tokenizer,
+            'args': model.args
+        }
+        if training is not None:
+            model_dict['training'] = training
+        self.queue.put((model_dict, output_path, epoch_checkpoint))
+
+    def run(self):
+        while True:
+            model_dict, output_path, epoch_checkpoint = self.queue.get()
+            try:
+                temp_path = f'{output_path}.tmp'
+                torch.save(model_dict, temp_path)
+                os.replace(temp_path, output_path)
+                if epoch_checkpoint:
+                    self.epoch_paths.append(output_path)
+                    while self.keep > 0 and len(self.epoch_paths) > self.keep:
+                        os.remove(self.epoch_paths.pop(0))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    # re-raises a failed write on the training thread
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # blocks until everything queued so far is on disk
+    def wait(self):
+        self.queue.join()
+        self.check()
 
 
 class ErsatzTrainer():
     
     def __init__(self, args):
         self.with_cuda = torch.cuda.is_available() and not args.cpu
-        self.device = torch.device("cuda:0" if self.with_cuda else "cpu")
+        # launched by torchrun: one process per device, gradients are all-reduced
+        self.world_size = int(os.environ.get('WORLD_SIZE', 1))
+        self.rank = int(os.environ.get('RANK', 0))
+        self.distributed = self.world_size > 1
+        local_rank = 0
+        if self.distributed:
+            local_rank = int(os.environ.get('LOCAL_RANK', 0))
+            if self.with_cuda:
+                torch.cuda.set_device(local_rank)
+            dist.init_process_group(backend=args.dist_backend)
+        self.device = torch.device(f"cuda:{local_rank}" if self.with_cuda else "cpu")
         self.output_path = args.output_path       
         self.batch_size = args.batch_size
+        self.num_workers = args.num_workers
 
         self.training_set = ErsatzDataset(args.train_path,
                                           self.device,
                                           sentencepiece_path=args.sentencepiece_path,
                                           left_context_size=args.left_size,
-                                          right_context_size=args.right_size)
+                                          right_context_size=args.right_size,
+                                          shuffle_buffer=args.shuffle_buffer,
+                                          seed=args.seed,
+                                          rank=self.rank,
+                                          world_size=self.world_size)
         self.validation_set = ErsatzDataset(args.valid_path,
                                             self.device,
                                             tokenizer=self.training_set.tokenizer,
@@ -146,15 +246,20 @@ class ErsatzTrainer():
             log_dir = f'runs/{args.determiner_type}.L{args.left_size}.R{args.right_size}.T{args.transformer_nlayers}.LIN{args.linear_nlayers}.E{args.eos_weight}.EMB{args.embed_size}.VOC{len(self.training_set.tokenizer)}'
         else:
             log_dir = args.tb_dir
-        self.writer = SummaryWriter(log_dir=log_dir)
+        # only rank 0 logs, validates and saves checkpoints
+        self.writer = SummaryWriter(log_dir=log_dir) if self.rank == 0 else None
 
         logging.info(f'{self.device}')
         if not os.path.exists(args.output_path):
             os.makedirs(args.output_path, exist_ok=True)
         
+        checkpoint = None
         if args.checkpoint_path is not None and os.path.exists(args.checkpoint_path):
             logging.info('Loading pre-existing model from checkpoint')
-            self.model = torch.load(args.output_path, map_location=self.device)
+            checkpoint = torch.load(args.checkpoint_path, map_location='cpu', weights_only=False)
+            self.model = ErsatzTransformer(self.training_set.tokenizer, checkpoint['args'])
+            self.model.load_state_dict(checkpoint['weights'])
+            self.model = self.model.to(self.device)
         else:
             self.model = ErsatzTransformer(self.training_set.tokenizer, args).to(self.device)
 
@@ -164,13 +269,95 @@ class ErsatzTrainer():
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr)
         self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, 1.0, gamma=0.95)
 
+        # mixed precision: bf16 needs no loss scaling, fp16 does
+        self.amp_dtype = {'off': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[args.amp]
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=args.amp == 'fp16')
+        # gradients of accum_steps batches are summed before every optimizer step
+        self.accum_steps = args.accum_steps
+
+        # resumable checkpoints (checkpoint.last) are written every checkpoint_interval batches
+        # and at the end of every epoch
+        self.checkpoint_interval = args.checkpoint_interval
+        # the batch of the current epoch it was last written at
+        self.last_checkpoint = 0
+        # position and counters to continue from, see training_state()
+        self.resume = None
+        if checkpoint is not None and 'training' in checkpoint:
+            self.load_training_state(checkpoint['training'], args.checkpoint_path)
+
+        self.checkpoints = CheckpointWriter(self.model.tokenizer.model_path, keep=args.keep_checkpoints)
+
         total_params = sum([p.numel() for p in self.model.parameters()])
         logging.info(f'Training with: {total_params}')
-        if self.with_cuda and torch.cuda.device_count() > 1:
+        if self.distributed:
+            logging.info(f'Rank {self.rank} of {self.world_size} ({args.dist_backend})')
+            # the only buffer (positional encodings) is constant, so it is not re-broadcast every step
+            self.model = nn.parallel.DistributedDataParallel(self.model, device_ids=[local_rank] if self.with_cuda else None,
+                                                             broadcast_buffers=False)
+        elif self.with_cuda and torch.cuda.device_count() > 1:
             logging.info("Using %d GPUSs for ET" % torch.cuda.device_count())
             self.model = nn.DataParallel(self.model) 
             self.model = self.model.cuda()
 
+    # everything besides the weights needed to continue training from where it stopped;
+    # readers[r] is the number of batches of this epoch from reader r (None: from the start),
+    # next_reader the one the DataLoader was about to read from.
+    # The other ranks only record their own data position, in checkpoint.last.rank<n>
+    def training_state(self, epoch, readers, results, status, best_model, next_reader=0):
+        state = {
+            'epoch': epoch,
+            'batch': 0 if readers is None else sum(readers),
+            'readers': None if readers is None else list(readers),
+            'next_reader': next_reader,
+        }
+        if self.rank != 0:
+            return state
+        state.update({
+            'optimizer': snapshot_state(self.optimizer.state_dict()),
+            'scheduler': self.scheduler.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'results': dict(results.__dict__),
+            'status': dict(status),
+            'best_model': best_model,
+            'rng': rng_state(),
+        })
+        return state
+
+    def save_training_state(self, epoch, readers, results, status, best_model, next_reader=0):
+        state = self.training_state(epoch, readers, results, status, best_model, next_reader)
+        path = os.path.join(self.output_path, 'checkpoint.last')
+        if self.rank == 0:
+            self.checkpoints.save(self.unwrapped_model(), path, training=state)
+        else:
+            torch.save(state, f'{path}.rank{self.rank}.tmp')
+            os.replace(f'{path}.rank{self.rank}.tmp', f'{path}.rank{self.rank}')
+        self.last_checkpoint = state['batch']
+
+    def load_training_state(self, state, checkpoint_path):
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        set_rng_state(state['rng'])
+        self.resume = state
+        if self.rank != 0 and state['readers'] is not None:
+            # the data position of this rank, if it was saved along with rank 0's checkpoint
+            rank_path = f'{checkpoint_path}.rank{self.rank}'
+            position = None
+            if os.path.exists(rank_path):
+                position = torch.load(rank_path, weights_only=False)
+            if position is not None and (position['epoch'], position['batch']) == (state['epoch'], state['batch']):
+                self.resume = dict(state, readers=position['readers'], next_reader=position['next_reader'])
+            else:
+                logging.info(f'No data position for rank {self.rank}, it restarts epoch {state["epoch"]}')
+                self.resume = dict(state, readers=None)
+        logging.info(f"Resuming epoch {state['epoch']} after {state['batch']} batches")
+
+    # the ErsatzTransformer inside DataParallel/DistributedDataParallel
+    def unwrapped_model(self):
+        if isinstance(self.model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            return self.model.module
+        return self.model
+
     def validate(self, batch_size, determiner, use_factors=False):
         retVal = {}
         retVal['num_obs_eos'] = 0
@@ -184,52 +371,53 @@ class ErsatzTrainer():
         retVal['inference_incorrect_eos'] = 0
         retVal['inference_correct_mos'] = 0
         retVal['inference_incorrect_mos'] = 0
-        self.model.eval()
+        # no collectives here: the other ranks keep training while rank 0 validates
+        model = self.unwrapped_model()
+        model.eval()
         eos_ind = 0
         mos_ind = 1
+        # the sums stay on the device and are read back once at the end
+        mask = self.validation_set.determiner_mask(determiner).to(self.device)
+        totals = torch.zeros(10, dtype=torch.float64, device=self.device)
+        start = 0
         with torch.no_grad():
             for i, (contexts, factors, labels, context_strings) in enumerate(self.validation_set.batchify(batch_size)):
-                data = contexts.to(self.device)
+                data = contexts.to(self.device, non_blocking=True)
 
                 if use_factors:
-                    factors = factors.to(self.device)
+                    factors = factors.to(self.device, non_blocking=True)
                 else:
                     factors = None
 
-                labels = labels.to(self.device)
-                output = self.model.forward(data, factors=factors)
+                labels = labels.to(self.device, non_blocking=True)
+                output = model.forward(data, factors=factors)
                 loss = self.criterion(output, labels)
-                perplexity = torch.exp(F.cross_entropy(output, labels)).item()
+                perplexity = torch.exp(F.cross_entropy(output, labels))
                 pred = output.argmax(1)
-        
-                retVal['num_pred'] += len(pred)
-                retVal['num_obs_eos'] += (labels==eos_ind).sum().item()
-                retVal['num_pred_eos'] += (pred==eos_ind).sum().item()
-
-                pred[pred!=eos_ind] = -1
-                pred = pred ^ labels
-                retVal['correct_eos'] += (pred==0).sum().item()
-
-                retVal['correct_mos'] = retVal['num_pred'] - (retVal['num_obs_eos'] + retVal['num_pred_eos'] - retVal['correct_eos'])
-        
-                retVal['total_loss'] += loss.item()
-                retVal['ppl'] += perplexity
-                for context_item, label_item, p in zip(context_strings, labels, torch.argmax(output, dim=1)):
-                    left_context = self.model.tokenizer.merge(context_item[0])
-                    right_context = self.model.tokenizer.merge(context_item[1])
-
-                    if determiner(left_context, right_context):
-                        if label_item == eos_ind:
-                            if p.item() == eos_ind:
-                                retVal['inference_correct_eos'] += 1
-                            else:
-                                retVal['inference_incorrect_eos'] += 1
-                        else:
-                            if p.item() == mos_ind:
-                                retVal['inference_correct_mos'] += 1
-                            else:
-                                retVal['inference_incorrect_mos'] += 1
 
+                obs_eos = labels == eos_ind
+                pred_eos = pred == eos_ind
+                # only the candidate sites count for the inference scores
+                candidates = mask[start:start+len(labels)]
+                start += len(labels)
+                totals += torch.stack((obs_eos.sum(),
+                                       pred_eos.sum(),
+                                       (obs_eos & pred_eos).sum(),
+                                       (candidates & obs_eos & pred_eos).sum(),
+                                       (candidates & obs_eos & ~pred_eos).sum(),
+                                       (candidates & ~obs_eos & (pred == mos_ind)).sum(),
+                                       (candidates & ~obs_eos & pred_eos).sum(),
+                                       labels.new_tensor(len(labels)),
+                                       loss,
+                                       perplexity)).double()
+
+        totals = totals.tolist()
+        retVal['num_obs_eos'], retVal['num_pred_eos'], retVal['correct_eos'], \
+            retVal['inference_correct_eos'], retVal['inference_incorrect_eos'], \
+            retVal['inference_correct_mos'], retVal['inference_incorrect_mos'], \
+            retVal['num_pred'] = [int(total) for total in totals[:8]]
+        retVal['total_loss'], retVal['ppl'] = totals[8:]
+        retVal['correct_mos'] = retVal['num_pred'] - (retVal['num_obs_eos'] + retVal['num_pred_eos'] - retVal['correct_eos'])
         retVal['average_loss'] = retVal['total_loss'] / len(self.validation_set)
         retVal['ppl_per_pred'] = retVal['ppl'] / len(self.validation_set)
         if retVal['inference_correct_eos'] + retVal['inference_incorrect_mos'] != 0:
@@ -247,7 +435,7 @@ class ErsatzTrainer():
 
         retVal['inference_acc'] = (retVal['inference_correct_eos'] + retVal['inference_correct_mos'])/(retVal['inference_correct_eos'] + retVal['inference_correct_mos'] + retVal['inference_incorrect_eos'] + retVal['inference_incorrect_mos'])
         retVal['average_loss'] = retVal['total_loss']/retVal['num_pred']
-        self.model.train()
+        model.train()
         return retVal
 
     def run_epoch(self, epoch, batch_size, 
@@ -263,79 +451,114 @@ class ErsatzTrainer():
 
         eos_ind = 0
         mos_ind = 1
-        for i, (contexts, factors, labels, context_strings) in enumerate(self.training_set.batchify(batch_size)):
-            data = contexts.to(self.device)
+        # the batches each DataLoader worker has read this epoch; a resumed epoch skips them
+        readers = [0] * max(self.num_workers, 1)
+        next_reader = 0
+        if self.resume is not None and self.resume['epoch'] == epoch and self.resume['readers'] is not None:
+            readers = list(self.resume['readers'])
+            next_reader = self.resume['next_reader']
+        self.resume = None
+        self.last_checkpoint = sum(readers)
+        # batches are built by background workers into pinned memory, so the copies can overlap compute
+        batches = self.training_set.loader(batch_size, num_workers=self.num_workers, pin_memory=self.with_cuda,
+                                           skip=list(readers), first_reader=next_reader)
+        # ranks can run out of batches at different times (and rank 0 can stop early);
+        # Join keeps the gradient all-reduce of the remaining ranks going
+        join = Join([self.model]) if self.distributed else contextlib.nullcontext()
+        # accumulation restarts every epoch so the ranks agree on which batches end with a step;
+        # the gradients of an incomplete last group are dropped
+        self.micro_batches = 0
+        self.optimizer.zero_grad()
+        with join:
+            for i, (contexts, factors, labels, reader) in enumerate(batches, sum(readers)):
+                readers[reader] += 1
+                next_reader = (reader + 1) % len(readers)
+                data = contexts.to(self.device, non_blocking=True)
 
-            if use_factors:
-                factors = factors.to(self.device)
-            else:
-                factors = None
+                if use_factors:
+                    factors = factors.to(self.device, non_blocking=True)
+                else:
+                    factors = None
 
-            labels = labels.to(self.device)
-            output = self.model.forward(data, factors=factors)
-            loss = self.criterion(output, labels)
-            ppl = torch.exp(F.cross_entropy(output, labels)).item()
-            pred = output.argmax(1)
-    
-            results.calculate(loss.item(), ppl, pred, labels, eos_ind)
+                labels = labels.to(self.device, non_blocking=True)
+                self.micro_batches += 1
+                step = self.micro_batches % self.accum_steps == 0
+                # gradients are only all-reduced on the batches that end with an optimizer step
+                sync = self.model.no_sync() if self.distributed and not step else contextlib.nullcontext()
+                with sync:
+                    with torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+                        output = self.model.forward(data, factors=factors)
+                        loss = self.criterion(output, labels)
+                    ppl = torch.exp(F.cross_entropy(output.float(), labels)).item()
+                    pred = output.argmax(1)
+
+                    results.calculate(loss.item(), ppl, pred, labels, eos_ind)
+
+                    self.scaler.scale(loss / self.accum_steps).backward()
+
+                if step:
+                    # clipping sees the real gradients, not the scaled ones
+                    self.scaler.unscale_(self.optimizer)
+                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.5)
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    self.optimizer.zero_grad()
         
-            self.optimizer.zero_grad() 
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.5)
-            self.optimizer.step()
-        
-            if results.batches % log_interval == 1:
-                status = results.get_results(self.scheduler.get_last_lr()[0])
-                logging.info(json.dumps(status))
-                for key in status:
-                    if type(status[key]) is float:
-                        time_mark = epoch * (len(self.training_set) * batch_size) + i
-                        self.writer.add_scalar(f'{key}/training', status[key], time_mark)
-                results.reset(time.time())
-
-            if results.batches % validation_interval == 1:
-                stats = self.validate(batch_size, determiner, use_factors=use_factors)
-                stats['type'] = 'VALIDATION'
-                results.validated()
-                stats['average_loss'] = stats['total_loss']/stats['num_pred']
-                stats['acc'] = (stats['correct_eos'] + stats['correct_mos'])/stats['num_pred']
-                if stats['num_pred_eos'] != 0:
-                    stats['prec'] = stats['correct_eos']/stats['num_pred_eos']
-                else:
-                    stats['prec'] = 0
-                if stats['num_obs_eos'] != 0:
-                    stats['recall'] = stats['correct_eos']/stats['num_obs_eos']
-                else:
-                    stats['recall'] = 0
-                if stats['prec'] != 0 and stats['recall'] != 0:
-                    stats['f1'] = 2*(stats['prec']*stats['recall'])/(stats['prec']+stats['recall'])
-                else:
-                    stats['f1'] = 0
-                logging.info(json.dumps(stats))
-                for key in stats:
-                    if type(stats[key]) is float:
-                        time_mark = status['validations']
-                        self.writer.add_scalar(f'{key}/validation', stats[key], time_mark)
-                if best_model is not None:
-                    if stats['inference_f1'] > best_model['inference_f1']:
-                        save_model(self.model, os.path.join(self.output_path, 'checkpoint.best'))
-                        self.model = self.model.to(self.device)
+                if self.rank == 0 and results.batches % log_interval == 1:
+                    status = results.get_results(self.scheduler.get_last_lr()[0])
+                    logging.info(json.dumps(status))
+                    for key in status:
+                        if type(status[key]) is float:
+                            time_mark = epoch * (len(self.training_set) * batch_size) + i
+                            self.writer.add_scalar(f'{key}/training', status[key], time_mark)
+                    results.reset(time.time())
+
+                if self.rank == 0 and results.batches % validation_interval == 1:
+                    stats = self.validate(batch_size, determiner, use_factors=use_factors)
+                    stats['type'] = 'VALIDATION'
+                    results.validated()
+                    stats['average_loss'] = stats['total_loss']/stats['num_pred']
+                    stats['acc'] = (stats['correct_eos'] + stats['correct_mos'])/stats['num_pred']
+                    if stats['num_pred_eos'] != 0:
+                        stats['prec'] = stats['correct_eos']/stats['num_pred_eos']
+                    else:
+                        stats['prec'] = 0
+                    if stats['num_obs_eos'] != 0:
+                        stats['recall'] = stats['correct_eos']/stats['num_obs_eos']
+                    else:
+                        stats['recall'] = 0
+                    if stats['prec'] != 0 and stats['recall'] != 0:
+                        stats['f1'] = 2*(stats['prec']*stats['recall'])/(stats['prec']+stats['recall'])
+                    else:
+                        stats['f1'] = 0
+                    logging.info(json.dumps(stats))
+                    for key in stats:
+                        if type(stats[key]) is float:
+                            time_mark = status['validations']
+                            self.writer.add_scalar(f'{key}/validation', stats[key], time_mark)
+                    if best_model is not None:
+                        if stats['inference_f1'] > best_model['inference_f1']:
+                            self.checkpoints.save(self.unwrapped_model(), os.path.join(self.output_path, 'checkpoint.best'))
+                            best_model = stats
+                            best_model['validation_num'] = status['validations']
+                            logging.info(f'SAVING MODEL: { json.dumps(best_model)}')
+                        else:
+                            if epoch > min_epochs and status['validations'] - best_model['validation_num'] >= validation_threshold:
+                                logging.info(f'EARLY STOPPING {json.dumps(best_model)}')
+                                return 0, status, best_model
+                    else:
+                        self.checkpoints.save(self.unwrapped_model(), os.path.join(self.output_path, 'checkpoint.best'))
                         best_model = stats
+                        logging.info(f'SAVING MODEL: { json.dumps(best_model) }')
                         best_model['validation_num'] = status['validations']
-                        logging.info(f'SAVING MODEL: { json.dumps(best_model)}')
-                    else:
-                        if epoch > min_epochs and status['validations'] - best_model['validation_num'] >= validation_threshold:
-                            logging.info(f'EARLY STOPPING {json.dumps(best_model)}')
-                            return 0, status, best_model
-                else:
-                    save_model(self.model, os.path.join(self.output_path, 'checkpoint.best'))
-                    self.model = self.model.to(self.device)
-                    best_model = stats
-                    logging.info(f'SAVING MODEL: { json.dumps(best_model) }')
-                    best_model['validation_num'] = status['validations']
-        logging.info(f'SAVING MODEL: End of epoch {epoch}')
-        save_model(self.model, os.path.join(self.output_path, f'checkpoint.e{epoch}')) 
-        self.model = self.model.to(self.device)
+
+                # only between optimizer steps, so there are no accumulated gradients to lose
+                if self.checkpoint_interval > 0 and step and i + 1 - self.last_checkpoint >= self.checkpoint_interval:
+                    self.save_training_state(epoch, readers, results, status, best_model, next_reader)
+        if self.rank == 0:
+            logging.info(f'SAVING MODEL: End of epoch {epoch}')
+            self.checkpoints.save(self.unwrapped_model(), os.path.join(self.output_path, f'checkpoint.e{epoch}'),
+                                  epoch_checkpoint=True)
         return 1, status, best_model
 
 def parse_args():
@@ -366,6 +589,13 @@ def parse_args():
     parser.add_argument('--cpu', action='store_true')
     parser.add_argument('--eos_weight', type=float, default=1.0)
     parser.add_argument('--seed', type=int, default=14)
+    parser.add_argument('--shuffle_buffer', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'])
+    parser.add_argument('--amp', type=str, default='off', choices=['off', 'bf16', 'fp16'])
+    parser.add_argument('--accum-steps', type=int, default=1)
+    parser.add_argument('--keep_checkpoints', type=int, default=0)
+    parser.add_argument('--checkpoint_interval', type=int, default=10000)
     parser.add_argument('--tb_dir', type=str, default=None)
     args = parser.parse_args()
     return args
@@ -392,8 +622,17 @@ def main():
     status['type'] = 'TRAINING'
     best_model = None
     results = Results(time.time())
-    for epoch in range(args.max_epochs):
+    start_epoch = 0
+    if trainer.resume is not None:
+        start_epoch = trainer.resume['epoch']
+        if trainer.rank == 0:
+            results.__dict__.update(trainer.resume['results'])
+            results.last_update = time.time()
+            status = trainer.resume['status']
+            best_model = trainer.resume['best_model']
+    for epoch in range(start_epoch, args.max_epochs):
         status['epoch'] = epoch
+        trainer.training_set.set_epoch(epoch)
         trainer.model.train()
         res, status, best_model = trainer.run_epoch(epoch, args.batch_size,
                                                     log_interval=args.log_interval,
@@ -405,9 +644,20 @@ def main():
                                                     validation_threshold=args.early_stopping,
                                                     use_factors=args.source_factors,
                                                     determiner=determiner)
+        if trainer.distributed:
+            # rank 0 decides on early stopping
+            stop = torch.tensor([res], device=trainer.device)
+            dist.broadcast(stop, 0)
+            res = stop.item()
         if res == 0 and epoch > args.min_epochs:
             break
         trainer.scheduler.step()
+        if args.checkpoint_interval > 0:
+            trainer.save_training_state(epoch + 1, None, results, status, best_model)
+
+    trainer.checkpoints.wait()
+    if trainer.distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
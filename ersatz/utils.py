@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import gzip
+import io
 import os
 import ssl
 import sys
@@ -364,6 +365,52 @@ MODELS = {
     },
 }
 
+# byte offsets that cut a file into roughly equal shards, each starting at the beginning of a line
+# with documents=True, shards only start right after a blank line (a document boundary)
+def shard_offsets(path, num_shards, documents=False):
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for n in range(1, num_shards):
+            position = max(size * n // num_shards, offsets[-1])
+            if position == 0:
+                continue
+            f.seek(position - 1)
+            f.readline()
+            if documents:
+                line = f.readline()
+                while line.strip():
+                    line = f.readline()
+            if offsets[-1] < f.tell() < size:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return offsets
+
+# raw reader over [start, end) of a file so a shard decodes exactly like the full file would
+class ShardReader(io.RawIOBase):
+    def __init__(self, path, start, end):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        read = self.file.readinto(memoryview(buffer)[:size])
+        self.remaining -= read
+        return read
+
+    def close(self):
+        self.file.close()
+        super(ShardReader, self).close()
+
+def open_shard(path, start, end):
+    return io.TextIOWrapper(io.BufferedReader(ShardReader(path, start, end)))
+
 def list_models():
     for model_name in MODELS:
         model = MODELS[model_name]
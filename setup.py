@@ -72,7 +72,7 @@ setup(
 
     license = 'Apache License 2.0',
 
-    python_requires = '>=3',
+    python_requires = '>=3.8',
 
     # See https://pypi.python.org/pypi?%3Aaction=list_classifiers
     classifiers = [
@@ -112,9 +112,10 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires = [
         'typing;python_version<"3.5"',
-        'torch==1.7.1',
-        'sentencepiece==0.1.95',
-        'tensorboard==2.4.1',
+        'torch>=2.3',
+        'numpy',
+        'sentencepiece>=0.1.95',
+        'tensorboard>=2.4.1',
         'progressbar2'
     ],
 
@@ -122,7 +123,9 @@ setup(
     # dependencies). You can install these using the following syntax,
     # for example:
     # $ pip install -e .[dev,test]
-    extras_require = {},
+    extras_require = {
+        'onnx': ['onnx', 'onnxruntime'],
+    },
 
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
@@ -132,7 +135,9 @@ setup(
             'ersatz = ersatz.split:main',
             'ersatz_train = ersatz.trainer:main',
             'ersatz_score = ersatz.score:main',
-            'ersatz_preprocess = ersatz.dataset:main'
+            'ersatz_preprocess = ersatz.dataset:main',
+            'ersatz_export = ersatz.export:main',
+            'ersatz_serve = ersatz.serve:main'
         ],
     },
 )
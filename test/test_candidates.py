@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from ersatz.candidates import (Split, PunctuationSpace, MultilingualPunctuation, AdditionalMultilingualPunctuation,
+                               IndividualPunctuation, ending_punc, additional_ending_punc, closing_punc, digits)
+from ersatz.subword import piece_offsets
+
+# every character the determiners look at, plus letters and whitespace around them
+ALPHABET = sorted(ending_punc | additional_ending_punc | set(''.join(closing_punc)) | digits) + \
+           list('abcXYZ') + [' '] * 6
+
+DETERMINERS = [
+    PunctuationSpace(),
+    MultilingualPunctuation(),
+    AdditionalMultilingualPunctuation(),
+    IndividualPunctuation('.'),
+    IndividualPunctuation('।'),
+]
+
+# a random line cut into random pieces, the way EvalModel.encode hands it to scan()
+def random_pieces(rng):
+    text = ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 40)))
+    pieces = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + rng.randint(1, 4))
+        pieces.append(text[start:end])
+        start = end
+    return pieces
+
+
+@pytest.mark.parametrize('determiner', DETERMINERS, ids=lambda d: type(d).__name__)
+def test_scan_matches_determiner(determiner):
+    rng = random.Random(14)
+    for _ in range(3000):
+        pieces = random_pieces(rng)
+        text = ''.join(pieces)
+        offsets = piece_offsets(pieces)
+        left_context_size = rng.randint(1, 6)
+        right_context_size = rng.randint(1, 6)
+        expected = Split.scan(determiner, text, offsets, left_context_size, right_context_size)
+        found = determiner.scan(text, offsets, left_context_size, right_context_size)
+        assert found == expected, (pieces, left_context_size, right_context_size)
+
+
+def test_split_scans_every_position():
+    pieces = ['a', 'b.', ' c']
+    assert Split().scan(''.join(pieces), piece_offsets(pieces), 2, 2) == [0, 1, 2]
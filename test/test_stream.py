@@ -0,0 +1,68 @@
+import io
+import random
+import argparse
+
+import pytest
+import torch
+
+from ersatz.split import EvalModel, load_candidates, forced_cut, STREAM_MAX_WORD
+from ersatz.model import ErsatzTransformer
+from ersatz.subword import SentencePiece
+
+WORDS = ['the', 'cat', 'sat', 'on', 'a', 'mat', 'Dr.', 'Smith', 'said', 'no', 'U.S.', 'e.g.', '3.5', 'it',
+         'was', '"fine."', '(yes)', 'why?', 'stop!', 'end.', 'x', 'word', 'sentence', 'here', '...']
+
+def random_line(rng, words=60):
+    line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, words)))
+    return line + rng.choice(['', '.', ' ', '  ', '!'])
+
+
+# an untrained model, so that splits land at random candidate sites
+@pytest.fixture(scope='module')
+def model(tmp_path_factory):
+    import sentencepiece as spm
+    rng = random.Random(7)
+    proto = io.BytesIO()
+    spm.SentencePieceTrainer.train(sentence_iterator=iter([random_line(rng) for _ in range(500)]),
+                                   model_writer=proto, vocab_size=50, bos_piece='<mos>', eos_piece='<eos>',
+                                   minloglevel=2)
+    args = argparse.Namespace(source_factors=True, factor_embed_size=4, transformer_nlayers=1, embed_size=16,
+                              nhead=2, dropout=0.1, left_size=4, right_size=3, linear_nlayers=0,
+                              activation_type='tanh')
+    torch.manual_seed(14)
+    network = ErsatzTransformer(SentencePiece(serialization=proto.getvalue()), args)
+    path = tmp_path_factory.mktemp('model') / 'model.pt'
+    torch.save({'weights': network.state_dict(), 'tokenizer': proto.getvalue(), 'args': args}, path)
+    model = EvalModel(str(path)).to(torch.device('cpu'))
+    model.model.requires_grad_(False)
+    return model
+
+def run(model, lines, candidates, **kwargs):
+    output = io.StringIO()
+    with torch.no_grad():
+        model.split(io.StringIO(''.join(lines)), output, 7, candidates=load_candidates(candidates), **kwargs)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('candidates', ['multilingual', 'en', 'all'])
+@pytest.mark.parametrize('chunk_size', [5, 16, 64])
+def test_stream_matches_plain(model, candidates, chunk_size):
+    rng = random.Random(chunk_size)
+    lines = [random_line(rng, words=200) + '\n' for _ in range(30)] + ['\n', 'no newline at the end.']
+    assert run(model, lines, candidates, stream=chunk_size) == run(model, lines, candidates)
+    assert run(model, lines, candidates, stream=chunk_size, pack=True) == run(model, lines, candidates)
+
+
+# text without whitespace is cut by force; only the splits near the cuts may differ
+def test_stream_without_whitespace(model):
+    rng = random.Random(3)
+    line = ''.join(rng.choice('abcdefgh.!') for _ in range(STREAM_MAX_WORD * 5)) + '\n'
+    streamed = run(model, [line], 'multilingual', stream=1000)
+    assert streamed.replace('\n', '') == run(model, [line], 'multilingual').replace('\n', '')
+
+
+def test_forced_cut():
+    candidates = load_candidates('multilingual')
+    assert forced_cut('abc.def.gh', candidates) == 8
+    assert forced_cut('abcdefgh.', candidates) == 8
+    assert forced_cut('abcdé', load_candidates('all')) == 4